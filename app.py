@@ -1,7 +1,9 @@
 import os
+import sys
 import csv
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import logging
+from datetime import datetime
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -9,16 +11,40 @@ from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from sqlalchemy import and_, insert, literal, select
+from sqlalchemy.exc import IntegrityError
+
+from fee_schedule import boundary_epoch, client_schedule
+from invoice_engine import invoice_statuses
+from log_config import setup_logging
+import client_cache
+import http_cache
+import metrics
+from metrics import JOB_SECONDS
+
+if __name__ == '__main__':
+    # Helper modules (outbox, ...) do `from app import ...`; make that resolve
+    # to this module instead of loading a second copy of the app
+    sys.modules.setdefault('app', sys.modules[__name__])
 
 # Load environment variables
 load_dotenv()
+setup_logging()
+# Not __name__: that is "__main__" under `python app.py`
+logger = logging.getLogger('app')
+# Per-request details; sample with LOG_SAMPLE=app.requests=0.1
+request_log = logging.getLogger('app.requests')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default_secret_key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///clients.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Larger request bodies, i.e. client uploads, are refused with a 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 20)) * 1024 * 1024
 
 db = SQLAlchemy(app)
+metrics.instrument_app(app)
+http_cache.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -27,8 +53,20 @@ login_manager.login_view = 'login'
 jobstores = {
     'default': SQLAlchemyJobStore(url=app.config['SQLALCHEMY_DATABASE_URI'])
 }
+# Not started at import: only the process holding the scheduler lease runs it
+# (worker.py, or the dev server via start_embedded_scheduler), so web workers
+# under gunicorn never schedule or send anything
 scheduler = BackgroundScheduler(jobstores=jobstores)
-scheduler.start()
+metrics.instrument_scheduler(scheduler)
+
+# Invoice dispatch: an hourly job queues what the send calendar has due into
+# the outbox in batches, then a bounded set of workers drains it.
+# Set to 0 when separate sender processes drain the outbox (worker.py)
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 8))
+DISPATCH_BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE', 50))
+# Above 1, each tick is split into this many shards that every worker node
+# helps queue; see dispatch_shards.py
+DISPATCH_SHARDS = int(os.getenv('DISPATCH_SHARDS', 1))
 
 # Models
 class User(UserMixin, db.Model):
@@ -39,6 +77,12 @@ class User(UserMixin, db.Model):
     smtp_port = db.Column(db.Integer, default=587)
     smtp_username = db.Column(db.String(120))
     smtp_password = db.Column(db.String(120))
+    # Jinja2 invoice templates; empty means the defaults in invoice_templates.py
+    invoice_subject = db.Column(db.String(200))
+    invoice_text = db.Column(db.Text)
+    invoice_html = db.Column(db.Text)
+    # Bumped with every change to the user's clients or revenue; see log_changes
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     clients = db.relationship('Client', backref='user', lazy=True)
 
     def set_password(self, password):
@@ -65,6 +109,20 @@ class Client(db.Model):
     payment_date = db.Column(db.DateTime)
     is_late = db.Column(db.Boolean, default=False)
 
+    # New indexes also need a step in migrations.py to reach existing databases.
+    # Lookups by user_id alone, and by send_day alone (the monthly reset), use
+    # the leading column of these composite indexes
+    __table_args__ = (
+        # Send-day lookups; dispatch itself reads the send calendar
+        db.Index('ix_client_send_day_hour_user', 'send_day', 'send_hour', 'user_id'),
+        # Keyset pagination in client_queries.list_clients
+        db.Index('ix_client_user_name', 'user_id', 'name'),
+        db.Index('ix_client_user_send_day', 'user_id', 'send_day'),
+        db.Index('ix_client_user_is_paid', 'user_id', 'is_paid'),
+        # The duplicate check in add_client, enforced
+        db.Index('uq_client_user_email', 'user_id', 'email', unique=True),
+    )
+
 class Revenue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Float, nullable=False)
@@ -73,6 +131,148 @@ class Revenue(db.Model):
     payment_date = db.Column(db.DateTime, default=datetime.utcnow)
     client = db.relationship('Client', backref='revenues')
 
+    __table_args__ = (
+        # Revenue totals and per-month GROUP BY in client_queries.dashboard_summary
+        db.Index('ix_revenue_user_payment_date', 'user_id', 'payment_date'),
+        # Undoing a payment in toggle_payment_status
+        db.Index('ix_revenue_client_id', 'client_id'),
+    )
+
+class Outbox(db.Model):
+    """A rendered invoice waiting to be (re)sent; see outbox.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)  # "<client_id>:<period>[:r<step>]"
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(7), nullable=False)  # Billing month, YYYY-MM
+    recipients = db.Column(db.Text, nullable=False)  # Comma separated
+    message = db.Column(db.Text, nullable=False)  # Serialized MIME message
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(120))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class ImportJob(db.Model):
+    """A bulk client upload being processed in the background; see client_import.py"""
+    id = db.Column(db.String(32), primary_key=True)  # Random hex, used in the status URL
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255))
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, done, failed
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # Fraction of the file read
+    rows_read = db.Column(db.Integer, nullable=False, default=0)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    duplicates = db.Column(db.Integer, nullable=False, default=0)
+    invalid = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)  # JSON list of the first invalid rows
+    rows_per_second = db.Column(db.Float)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    path = db.Column(db.String(500))  # The saved upload, in UPLOAD_DIR until the job ends
+    format = db.Column(db.String(10))  # csv or jsonl
+    heartbeat_at = db.Column(db.DateTime)  # Last progress commit; a running job without one for long has died
+
+class SchemaMigration(db.Model):
+    """A migration from migrations.py that has been applied"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class DispatchShard(db.Model):
+    """One hash slice of an hourly dispatch tick; see dispatch_shards.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    # The tick: YYYY-MM, day of month and hour
+    period = db.Column(db.String(7), nullable=False)
+    send_day = db.Column(db.Integer, nullable=False)
+    send_hour = db.Column(db.Integer, nullable=False)
+    shard = db.Column(db.Integer, nullable=False)  # Clients with id % shards == shard
+    shards = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, done
+    # Keyset position (user id, SendCalendar id) of the last queued entry, so a takeover resumes there
+    last_user_id = db.Column(db.Integer, nullable=False, default=0)
+    last_client_id = db.Column(db.Integer, nullable=False, default=0)
+    queued = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('period', 'send_day', 'send_hour', 'shard', name='uq_dispatch_shard'),
+        db.Index('ix_dispatch_shard_status', 'status'),
+    )
+
+class SendCalendar(db.Model):
+    """When a client's next invoice or late-fee reminder is due; see send_calendar.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # invoice, reminder
+    due_at = db.Column(db.DateTime, nullable=False)
+    period = db.Column(db.String(7), nullable=False)  # Billing month the invoice or reminder is for
+    step = db.Column(db.Integer)  # Reminders: index of the fee step
+
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'kind', name='uq_send_calendar_client_kind'),
+        # The dispatch tick's range query
+        db.Index('ix_send_calendar_due_at', 'due_at'),
+    )
+
+class ChangeLog(db.Model):
+    """A client change in its owner's invoice change feed; see change_feed.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)  # The owner's data_version after the change
+    client_id = db.Column(db.Integer, nullable=False)  # No foreign key: deletions are logged too
+    op = db.Column(db.String(10), nullable=False)  # upsert, delete
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_change_log_user_seq', 'user_id', 'seq'),
+        # Pruning by age
+        db.Index('ix_change_log_created_at', 'created_at'),
+    )
+
+class Lease(db.Model):
+    """Time-limited ownership of a named role such as the scheduler; see leases.py"""
+    name = db.Column(db.String(120), primary_key=True)
+    holder = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+def bump_data_version(user_ids):
+    """
+    Mark users' client data as changed, in the caller's transaction. Page
+    ETags and cache keys include data_version, so every process sees it.
+    `user_ids` is a user id or a query of them.
+    """
+    ids = [user_ids] if isinstance(user_ids, int) else user_ids
+    User.query.filter(User.id.in_(ids)).update({'data_version': User.data_version + 1}, synchronize_session=False)
+
+def log_changes(*criteria, op='upsert'):
+    """
+    Record a change to the clients matching `criteria`, in the caller's
+    transaction: bumps each owner's data_version and logs every client in
+    the owner's change feed under the new version. Call before deleting (the
+    rows must still exist) and after adding (flush first, for the id).
+    """
+    matching = and_(*criteria)
+    bump_data_version(select(Client.user_id).where(matching).distinct())
+    db.session.execute(insert(ChangeLog).from_select(
+        ['user_id', 'seq', 'client_id', 'op', 'created_at'],
+        select(Client.user_id, User.data_version, Client.id, literal(op), literal(datetime.utcnow()))
+        .join(User, User.id == Client.user_id).where(matching)
+    ))
+
+def page_version(user):
+    """What a user's client pages depend on besides their options"""
+    return user.id, user.data_version, boundary_epoch()
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -137,50 +337,40 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # 🔍 DEBUG: Verify user context and client count
-    print(f"[DEBUG] Logged in as: {current_user.email} (ID: {current_user.id})")
+    from change_feed import POLL_SECONDS, STREAM_ENABLED
+    from client_queries import dashboard_summary
 
-    clients = Client.query.filter_by(user_id=current_user.id).all()
-    print(f"[DEBUG] Found {len(clients)} clients for this user")
+    options = list_options()
+    version = page_version(current_user)
+    not_modified = http_cache.conditional(http_cache.etag_for('dashboard', version, options))
+    if not_modified:
+        return not_modified
 
-    invoice_status = []
-    total_revenue = 0
+    page, next_cursor = client_page(version, options)
+    request_log.debug("Dashboard for user %s: %d clients", current_user.id, len(page))
 
-    for client in clients:
-        # Calculate if payment is late
-        days_since_creation = (datetime.utcnow() - client.created_at).days
-        is_late = days_since_creation > client.grace_period and not client.is_paid
+    # Copies, so the cached page keeps the stored is_late for view_clients.
+    # The dashboard treats an invoice as late while it is overdue and unpaid
+    invoice_status = [dict(status, is_late=status['is_overdue'] and not status['is_paid']) for status in page]
 
-        # Calculate final cost (including late fee if applicable)
-        final_cost = client.cost
-        if is_late:
-            final_cost *= 1.1  # 10% late fee
-
-        # Only add to revenue if payment is marked as paid
-        if client.is_paid:
-            total_revenue += final_cost
-
-        invoice_status.append({
-            'id': client.id,
-            'name': client.name,
-            'email': client.email,
-            'base_cost': client.cost,
-            'final_cost': final_cost,
-            'send_date': client.send_day,
-            'grace_period': client.grace_period,
-            'is_paid': client.is_paid,
-            'is_late': is_late
-        })
+    totals = client_cache.clients.get(current_user.id, ('summary', version), lambda: dashboard_summary(current_user.id))
 
     return render_template('dashboard.html', 
                            invoice_status=invoice_status,
-                           total_revenue=total_revenue)
-
-import traceback
+                           total_revenue=totals['total_revenue'],
+                           totals=totals,
+                           next_url=page_url('dashboard', next_cursor) if next_cursor else None,
+                           seq=version[1],
+                           epoch=version[2],
+                           changes_url=url_for('invoice_changes'),
+                           stream_url=url_for('invoice_stream') if STREAM_ENABLED else None,
+                           poll_seconds=POLL_SECONDS)
 
 @app.route('/add_client', methods=['GET', 'POST'])
 @login_required
 def add_client():
+    from send_calendar import schedule_client
+
     if request.method == 'POST':
         try:
             existing_client = Client.query.filter_by(email=request.form.get('email'), user_id=current_user.id).first()
@@ -193,7 +383,7 @@ def add_client():
                 value = request.form.get(field)
                 if not value:
                     flash(f"{field} is required.")
-                    print(f"[DEBUG] Missing field: {field}")
+                    request_log.debug("Add client: missing field %s", field)
                     return redirect(url_for('add_client'))
 
             client = Client(
@@ -211,16 +401,24 @@ def add_client():
             )
 
             db.session.add(client)
-            db.session.commit()
+            try:
+                db.session.flush()
+                log_changes(Client.id == client.id)
+                schedule_client(client)
+                db.session.commit()
+            except IntegrityError:
+                # Added by a concurrent request since the check above
+                db.session.rollback()
+                flash("A client with this email already exists.")
+                return redirect(url_for('add_client'))
 
-            print(f"[DEBUG] ✅ Client '{client.name}' added with ID {client.id}")
-            schedule_email_job(client)
+            client_cache.invalidate(current_user.id)
+            logger.info("✅ Client %s added for user %s", client.id, current_user.id)
             flash("Client added successfully")
             return redirect(url_for('dashboard'))
 
         except Exception as e:
-            print("[ERROR] Exception occurred while adding client")
-            traceback.print_exc()  
+            logger.exception("Exception occurred while adding client")
             db.session.rollback()
             flash("Something went wrong. Check server logs.")
             return redirect(url_for('add_client'))
@@ -230,18 +428,145 @@ def add_client():
 @app.route('/view_clients')
 @login_required
 def view_clients():
-    # Force a fresh query from the database
-    db.session.expire_all()
-    clients = Client.query.filter_by(user_id=current_user.id).all()
-    invoice_status = [get_invoice_status_for_client(client) for client in clients]
-    print(f"View clients - Found {len(clients)} clients")
-    for client in clients:
-        print(f"Client: {client.name}, Status: {client.is_paid}")
-    return render_template('view_clients.html', invoice_status=invoice_status)
+    options = list_options()
+    version = page_version(current_user)
+    not_modified = http_cache.conditional(http_cache.etag_for('view_clients', version, options))
+    if not_modified:
+        return not_modified
+
+    invoice_status, next_cursor = client_page(version, options)
+    request_log.debug("View clients for user %s: %d clients", current_user.id, len(invoice_status))
+    return render_template('view_clients.html',
+                           invoice_status=invoice_status,
+                           options=options,
+                           first_url=page_url('view_clients') if options['after'] else None,
+                           next_url=page_url('view_clients', next_cursor) if next_cursor else None)
+
+@app.route('/api/clients')
+@login_required
+def api_clients():
+    """One page of clients as JSON; pass `next` back as `after` for the next page"""
+    from client_queries import status_json
+
+    options = list_options()
+    version = page_version(current_user)
+    not_modified = http_cache.conditional(http_cache.etag_for('api_clients', version, options))
+    if not_modified:
+        return not_modified
+
+    invoice_status, next_cursor = client_page(version, options)
+    return jsonify({
+        'clients': [status_json(status) for status in invoice_status],
+        'next': next_cursor
+    })
+
+@app.route('/api/invoices/changes')
+@login_required
+def invoice_changes():
+    """Status changes after seq `since`; see change_feed.py"""
+    from change_feed import changes_since, parse_since
+
+    return jsonify(changes_since(current_user.id, parse_since(request.args.get('since'))))
+
+@app.route('/api/invoices/stream')
+@login_required
+def invoice_stream():
+    """The same changes as Server-Sent Events, when CHANGE_STREAM is on"""
+    from change_feed import STREAM_ENABLED, claim_stream, parse_since, release_stream, stream
+
+    if not STREAM_ENABLED:
+        abort(404)
+    user_id = current_user.id
+    if not claim_stream(user_id):
+        # EventSource gives up on an error status; the dashboard falls back to polling
+        return Response(status=429, headers={'Retry-After': '60'})
+
+    # EventSource sends the last event id when it reconnects
+    since = parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    response = Response(stream_with_context(stream(user_id, since)), mimetype='text/event-stream')
+    # Runs when the server closes the response, even if the client left before it started
+    response.call_on_close(lambda: release_stream(user_id))
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let a proxy buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def list_options():
+    """parse_list_args for this request; a cursor from another sort is a 400"""
+    from client_queries import parse_list_args
+
+    try:
+        return parse_list_args(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+def client_page(version, options):
+    """(invoice statuses, next cursor) for one page of a user's clients at a page_version()"""
+    from client_queries import list_clients
+
+    user_id = version[0]
+
+    def load():
+        clients, next_cursor = list_clients(user_id, **options)
+        # One vectorized pass instead of per-client date and fee math
+        return invoice_statuses(clients), next_cursor
+
+    return client_cache.clients.get(user_id, ('page', version, tuple(sorted(options.items()))), load)
+
+@app.route('/upload_clients', methods=['POST'])
+@login_required
+def upload_clients():
+    """Queue a CSV or JSONL file of clients for import; poll the returned status_url"""
+    from client_import import UPLOAD_FORMATS, start_import
+
+    upload = request.files.get('file')
+    filename = upload.filename if upload else ''
+    extension = os.path.splitext(filename)[1].lower()
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+    if extension not in UPLOAD_FORMATS:
+        message = 'Upload a .csv or .jsonl file of clients'
+        if is_ajax:
+            return jsonify({'success': False, 'message': message}), 400
+        flash(message)
+        return redirect(url_for('add_client'))
+
+    job = start_import(upload, current_user.id)
+    status_url = url_for('import_status', job_id=job.id)
+    if is_ajax:
+        return jsonify({'success': True, 'job_id': job.id, 'status_url': status_url}), 202
+    flash(f'Importing {filename}; new clients will appear shortly')
+    return redirect(url_for('view_clients'))
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    message = f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB"
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': False, 'message': message}), 413
+    flash(message)
+    return redirect(url_for('add_client'))
+
+@app.route('/api/imports/<job_id>')
+@login_required
+def import_status(job_id):
+    from client_import import job_json
+
+    job = ImportJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify(job_json(job))
+
+def page_url(endpoint, cursor=None):
+    """Link to the page after `cursor` (or the first page), keeping sort and filters"""
+    args = request.args.to_dict()
+    args.pop('after', None)
+    if cursor:
+        args['after'] = cursor
+    return url_for(endpoint, **args)
 
 @app.route('/edit_client/<int:client_id>', methods=['GET', 'POST'])
 @login_required
 def edit_client(client_id):
+    from send_calendar import schedule_client
+
     client = Client.query.get_or_404(client_id)
 
     if client.user_id != current_user.id:
@@ -267,10 +592,16 @@ def edit_client(client_id):
 
         client.send_hour = 9  # Default to 9AM PST
 
-        db.session.commit()
-
-        # Reschedule the job
-        reschedule_email_job(client)
+        try:
+            log_changes(Client.id == client.id)
+            # Moves the next invoice to the new send day
+            schedule_client(client)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("A client with this email already exists.")
+            return redirect(url_for('edit_client', client_id=client_id))
+        client_cache.invalidate(current_user.id)
 
         flash('Client updated successfully')
         return redirect(url_for('view_clients'))
@@ -281,19 +612,19 @@ def edit_client(client_id):
 @app.route('/delete_client/<int:client_id>')
 @login_required
 def delete_client(client_id):
+    from send_calendar import forget
+
     client = Client.query.get_or_404(client_id)
     
     if client.user_id != current_user.id:
         flash('You do not have permission to delete this client')
         return redirect(url_for('dashboard'))
     
-    # Remove the scheduled job
-    job_id = f"email_job_{client.id}"
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-    
+    log_changes(Client.id == client.id, op='delete')
+    forget(client.id)
     db.session.delete(client)
     db.session.commit()
+    client_cache.invalidate(current_user.id)
     
     flash('Client deleted successfully')
     return redirect(url_for('view_clients'))
@@ -310,53 +641,80 @@ def settings():
         new_password = request.form.get('smtp_password')
         if new_password:
             current_user.smtp_password = new_password
+
+        # Invoice templates; anything left blank or unchanged uses the default
+        from invoice_templates import DEFAULT_SUBJECT, DEFAULT_TEXT, validate_template
+
+        subject = (request.form.get('invoice_subject') or '').strip()
+        text = (request.form.get('invoice_text') or '').replace('\r\n', '\n')
+        html = (request.form.get('invoice_html') or '').replace('\r\n', '\n')
+        error = validate_template(subject, text, html)
+        if error:
+            db.session.rollback()
+            flash(f'Invoice template error: {error}')
+            return redirect(url_for('settings'))
+        current_user.invoice_subject = subject if subject and subject != DEFAULT_SUBJECT else None
+        current_user.invoice_text = text if text.strip() and text != DEFAULT_TEXT else None
+        current_user.invoice_html = html if html.strip() else None
         
         db.session.commit()
         flash('Settings updated successfully')
         return redirect(url_for('dashboard'))
     
-    return render_template('settings.html')
+    from invoice_templates import DEFAULT_SUBJECT, DEFAULT_TEXT
+
+    return render_template('settings.html', default_subject=DEFAULT_SUBJECT, default_text=DEFAULT_TEXT)
 
 @app.route('/toggle_payment_status/<int:client_id>', methods=['POST'])
 @login_required
 def toggle_payment_status(client_id):
+    from send_calendar import payment_changed
+
     try:
-        print(f"Toggle payment status called for client_id: {client_id}")
-        
         # Get the client from the database
         client = Client.query.get_or_404(client_id)
-        print(f"Found client: {client.name}, current is_paid: {client.is_paid}")
         
         # Check permissions
         if client.user_id != current_user.id:
-            print(f"Permission denied: client.user_id={client.user_id}, current_user.id={current_user.id}")
+            logger.warning("User %s may not update client %s", current_user.id, client_id)
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify({'success': False, 'message': 'Permission denied'})
             flash('You do not have permission to update this client')
             return redirect(url_for('dashboard'))
         
         # Toggle payment status
+        previous_payment_date = client.payment_date
+        schedule = client_schedule(client)
         client.is_paid = not client.is_paid
         client.payment_date = datetime.utcnow() if client.is_paid else None
-        client.is_late = datetime.utcnow() > (client.created_at + timedelta(days=client.grace_period))
-        
-        print(f"Updated client: is_paid={client.is_paid}, payment_date={client.payment_date}, is_late={client.is_late}")
+        client.is_late = schedule.is_overdue(datetime.now())
         
         # Create revenue entry if marked as paid
         if client.is_paid:
             revenue = Revenue(
-                amount=client.cost,
+                amount=schedule.amount_at(datetime.now()),
                 client_id=client.id,
-                user_id=current_user.id
+                user_id=current_user.id,
+                payment_date=client.payment_date
             )
             db.session.add(revenue)
             flash('Payment marked as received')
         else:
+            # Undo the payment recorded by the previous toggle so revenue
+            # totals stay correct
+            if previous_payment_date:
+                Revenue.query.filter_by(
+                    client_id=client.id, payment_date=previous_payment_date
+                ).delete(synchronize_session=False)
             flash('Payment marked as pending')
         
         # Save changes to database
+        log_changes(Client.id == client.id)
+        payment_changed(client)
         db.session.commit()
-        print("Changes committed to database")
+        client_cache.invalidate(current_user.id)
+        request_log.info("Client %s marked %s", client.id, 'paid' if client.is_paid else 'unpaid',
+                         extra={'client_id': client.id, 'is_paid': client.is_paid, 'is_late': client.is_late})
         
         # Return JSON response for AJAX requests
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -367,7 +725,7 @@ def toggle_payment_status(client_id):
             })
         
     except Exception as e:
-        print(f"Error in toggle_payment_status: {str(e)}")
+        logger.exception("Error in toggle_payment_status for client %s", client_id)
         db.session.rollback()
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'message': str(e)})
@@ -375,53 +733,129 @@ def toggle_payment_status(client_id):
     
     return redirect(url_for('view_clients'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target; see metrics.py"""
+    # Checked before the queue depth query, so unauthenticated requests cost nothing
+    if not metrics.authorized(request.headers.get('Authorization')):
+        abort(404)
+    counts = db.session.query(Outbox.status, db.func.count(Outbox.id)) \
+        .filter(Outbox.status.in_(('pending', 'sending', 'failed'))) \
+        .group_by(Outbox.status)
+    metrics.set_queue_depth(dict(counts))
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
 # Helper functions
+# Jobs from before the send calendar: per-client jobs, one per (send_day,
+# send_hour) bucket, the bucket sync and the midnight payment reset
+LEGACY_JOBS = ('email_job_', 'dispatch_bucket_sync', 'monthly_payment_reset')
+
 def init_scheduler():
-    """Initialize the scheduler with all existing client jobs"""
+    """Drop jobs left in the job store by older versions"""
     with app.app_context():
-        clients = Client.query.all()
-        for client in clients:
-            schedule_email_job(client)
+        for job in scheduler.get_jobs():
+            legacy_bucket = job.id.startswith('dispatch_') and job.id[len('dispatch_'):].replace('_', '').isdigit()
+            if job.id.startswith(LEGACY_JOBS) or legacy_bucket:
+                scheduler.remove_job(job.id)
+
+def start_scheduler():
+    """Start (or resume) running scheduled jobs in this process"""
+    if scheduler.running:
+        scheduler.resume()
+        return
 
-# Call this after creating all tables
-@app.before_first_request
-def setup_scheduler():
+    scheduler.start()
     init_scheduler()
 
-    # monthly reset job
+    # Invoices and reminders from the send calendar; send times are on the hour
+    scheduler.add_job(
+        dispatch_due,
+        # CronTrigger(minute="*"),  # every minute for testing
+        CronTrigger(minute=0),
+        id='dispatch_due',
+        coalesce=True,
+        replace_existing=True
+    )
+
     scheduler.add_job(
-        reset_client_payment_statuses,
+        prune_change_log,
         trigger='cron',
-        hour=0,  # Midnight UTC
-        id='monthly_payment_reset',
+        hour=1,
+        id='change_log_prune',
         replace_existing=True
     )
 
-def schedule_email_job(client):
-    """Schedule or update the email job for a client"""
-    job_id = f"email_job_{client.id}"
-    
-    # Remove existing job if it exists
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-    
-    # Create a new job
     scheduler.add_job(
-        send_invoice_email,
-        # CronTrigger(minute="*"),  # every minute for testing
-        CronTrigger(day=client.send_day, hour=9),
-        args=[client.id],
-        id=job_id,
+        prune_outbox,
+        trigger='cron',
+        hour=1,
+        minute=30,
+        id='outbox_prune',
         replace_existing=True
     )
 
-def reschedule_email_job(client):
-    schedule_email_job(client)
+    # Bulk uploads saved by the web app
+    scheduler.add_job(
+        run_imports,
+        trigger='interval',
+        seconds=5,
+        id='client_imports',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
 
+    # Picks up invoices whose earlier send attempts failed once their backoff expires
+    scheduler.add_job(
+        retry_outbox,
+        trigger='interval',
+        minutes=1,
+        id='outbox_retry',
+        replace_existing=True
+    )
+
+def stop_scheduler():
+    """Stop running jobs here, e.g. after losing the scheduler lease"""
+    if scheduler.running:
+        scheduler.pause()
+
+def start_embedded_scheduler():
+    """Run the scheduler in this process whenever it wins the scheduler lease"""
+    from leases import LeaderElection
+    from outbox import worker_name
+
+    election = LeaderElection('scheduler', worker_name(), start_scheduler, stop_scheduler)
+    election.start()
+    return election
+
+def invoice_kwargs(client, user):
+    """Arguments for main.send_invoice, detached from the ORM session"""
+    from main import SMTP_SERVER, SMTP_PORT
+
+    # Amount due and deadline for the current billing period
+    now = datetime.now()
+    schedule = client_schedule(client, now)
+
+    return dict(
+        email=client.email,
+        name=client.name,
+        cc=client.cc,
+        cost=schedule.amount_at(now),
+        message=client.message,
+        sender_email=user.smtp_username,
+        sender_password=user.smtp_password,
+        late_fee_note=schedule.late_fee_note(now),
+        grace_deadline=schedule.grace_deadline,
+        late_fee_amount=client.late_fee,
+        occupancy_days=client.duration,
+        smtp_server=user.smtp_server or SMTP_SERVER,
+        smtp_port=user.smtp_port or SMTP_PORT
+    )
+
+@JOB_SECONDS.labels('send_invoice_email').time()
 def send_invoice_email(client_id):
     client = Client.query.get(client_id)
-    message = client.message or "No custom message provided."
-
     if not client:
         return
     
@@ -429,104 +863,79 @@ def send_invoice_email(client_id):
     if not user:
         return
     
-    # Import the send_invoice function from main.py
-    from main import send_invoice
-    
-    # Calculate the invoice date and apply late fees
-    invoice_sent_date = datetime(datetime.now().year, datetime.now().month, 1)
-    grace_deadline = invoice_sent_date + timedelta(days=client.grace_period, hours=23, minutes=59)
-    
-    # Send the invoice
-    send_invoice(
-        client.email, 
-        client.name, 
-        client.cc,
-        client.cost, 
-        client.message,
-        user.smtp_username, 
-        user.smtp_password,
-        "",  # late_fee_note will be calculated in the function
-        grace_deadline,
-        client.late_fee,
-        client.duration
-    )
+    from outbox import billing_period, enqueue_invoices, idempotency_key, send_queued
 
-def apply_late_fees(cost, grace_period, duration, late_fee, invoice_sent_date):
+    # Queued first so a failed send is retried rather than lost; only this
+    # invoice is sent here, the rest of the outbox is left to the senders
+    enqueue_invoices([(client, user)])
+    send_queued(idempotency_key(client.id, billing_period()))
+
+@JOB_SECONDS.labels('dispatch_due').time()
+def dispatch_due(now=None):
     """
-    Calculate the final cost and late fee note based on whether the invoice is overdue.
+    Queue every invoice and reminder the send calendar has due by the top
+    of the current hour, then send them.
+
+    Due entries are read from the calendar's due_at index in keyset pages,
+    so a tick costs the same however many clients aren't due. With
+    DISPATCH_SHARDS set, the tick is split into shards that every worker
+    node claims and queues in parallel. Sending is done by DISPATCH_WORKERS
+    outbox workers that share pooled SMTP sessions.
     """
-    now = datetime.now()
-    grace_deadline = invoice_sent_date + timedelta(days=grace_period)
+    from outbox import drain, worker_name
+    from send_calendar import dispatch, due_page
 
-    if now > grace_deadline:
-        # Calculate how many times the late fee should be applied
-        days_late = (now - grace_deadline).days
-        fee_multiplier = (days_late // duration) + 1
-        additional_fee = late_fee * fee_multiplier
-        final_cost = cost + additional_fee
-        late_fee_note = f"{fee_multiplier}x late fee applied (${additional_fee:.2f})"
-    else:
-        final_cost = cost
-        late_fee_note = "No late fee"
+    tick = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+    with app.app_context():
+        if DISPATCH_SHARDS > 1:
+            from dispatch_shards import start_run, work_shards
+
+            if start_run(tick, DISPATCH_SHARDS):
+                # Other nodes' ShardWorkers join in; this one works until no shard is left unclaimed
+                work_shards(worker_name())
+        else:
+            last_seen = (0, 0)
+            while True:
+                rows = due_page(tick, last_seen)
+                if not rows:
+                    break
+                last_seen = (rows[-1][0].user_id, rows[-1][0].id)
+                dispatch(rows, tick)
+
+    if DISPATCH_WORKERS:
+        drain(workers=DISPATCH_WORKERS)
 
-    return final_cost, late_fee_note
+def retry_outbox():
+    from outbox import drain
 
+    if DISPATCH_WORKERS:
+        drain(workers=DISPATCH_WORKERS)
+
+@JOB_SECONDS.labels('run_imports').time()
+def run_imports():
+    from client_import import run_queued_imports
 
-def reset_client_payment_statuses():
     with app.app_context():
-        today = datetime.utcnow()
-        clients = Client.query.all()
-        for client in clients:
-            # Reset only if the invoice send day matches today
-            if today.day == client.send_day:
-                client.is_paid = False
-                client.payment_date = None
-                db.session.commit()
+        run_queued_imports()
 
+@JOB_SECONDS.labels('prune_outbox').time()
+def prune_outbox():
+    from outbox import prune
 
+    with app.app_context():
+        logger.info("🧹 Pruned %d outbox rows", prune())
 
-def get_invoice_status_for_client(client):
-    # Calculate invoice sent date
-    current_date = datetime.now()
-    invoice_sent_date = datetime(current_date.year, current_date.month, min(client.send_day, 28))
-    
-    # If the send day has already passed this month, use next month
-    if current_date.day > client.send_day:
-        if current_date.month == 12:
-            invoice_sent_date = datetime(current_date.year + 1, 1, min(client.send_day, 28))
-        else:
-            invoice_sent_date = datetime(current_date.year, current_date.month + 1, min(client.send_day, 28))
-    
-    # Calculate final cost and late fees
-    final_cost, late_fee_note = apply_late_fees(
-        client.cost, client.grace_period, client.duration, 
-        client.late_fee, invoice_sent_date
-    )
-    
-    # Calculate grace deadline and overdue status
-    grace_deadline = invoice_sent_date + timedelta(days=client.grace_period, hours=23, minutes=59)
-    is_overdue = datetime.now() > grace_deadline
-    
-    return {
-        'id': client.id,
-        'client_name': client.name,
-        'email': client.email,
-        'base_cost': client.cost,
-        'final_cost': final_cost,
-        'grace_period': client.grace_period,
-        'grace_deadline': grace_deadline,
-        'is_overdue': is_overdue,
-        'late_fee_note': late_fee_note,
-        'send_date': client.send_day,
-        'invoice_sent_date': invoice_sent_date,
-        'is_paid': client.is_paid,
-        'payment_date': client.payment_date,
-        'is_late': client.is_late
-    }
-
-# Create database tables
-with app.app_context():
-    db.create_all()
+@JOB_SECONDS.labels('prune_change_log').time()
+def prune_change_log():
+    from change_feed import prune
+
+    with app.app_context():
+        logger.info("🧹 Pruned %d change log rows", prune())
+
+# Create tables and bring older databases up to date
+from migrations import upgrade
+upgrade()
 
 if __name__ == '__main__':
+    start_embedded_scheduler()
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""
+Asyncio invoice sending pipeline used by `process_clients(mode="async")`.
+
+A producer walks the invoice iterator into a bounded queue and a fixed set of
+consumers drain it. The queue bound gives backpressure: the producer stops
+reading the CSV while senders are busy, so memory stays flat however big the
+file is. The iterator is advanced on a worker thread, so parsing, PDF waits
+and rendering don't stall the SMTP coroutines on the event loop. Each sender account gets its own concurrency semaphore, token bucket
+and small set of reusable aiosmtplib connections.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiosmtplib
+
+from log_config import redact
+from main import build_invoice, invoice_log, SMTP_SERVER, SMTP_PORT
+from metrics import SMTP_PHASE_SECONDS, record_send
+from smtp_pool import RECONNECT_CODES, STARTTLS
+
+# Gmail and most hosted providers throttle per account per minute; stay under
+# their caps by default and let the CLI/env override for other providers
+DEFAULT_CONCURRENCY = int(os.getenv('ASYNC_SMTP_CONCURRENCY', 3))
+DEFAULT_RATE_PER_MINUTE = float(os.getenv('ASYNC_SMTP_RATE_PER_MINUTE', 60))
+DEFAULT_WORKERS = int(os.getenv('ASYNC_SMTP_WORKERS', 16))
+QUEUE_SIZE_PER_WORKER = 4
+
+
+class TokenBucket:
+    """Allows `rate_per_minute` acquisitions per minute, bursting up to `burst`."""
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SenderAccount:
+    """Concurrency limit, rate limit and idle connections for one SMTP login."""
+
+    def __init__(self, server, port, username, password, concurrency, rate_per_minute, start_tls=True):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.start_tls = start_tls
+        self.slots = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate_per_minute)
+        self.idle = []
+
+    async def _connect(self):
+        # Each step done explicitly rather than inside connect(), to time them apart
+        smtp = aiosmtplib.SMTP(hostname=self.server, port=self.port, start_tls=False)
+        with SMTP_PHASE_SECONDS.labels('connect').time():
+            await smtp.connect()
+        try:
+            if self.start_tls:
+                with SMTP_PHASE_SECONDS.labels('starttls').time():
+                    await smtp.starttls()
+            if self.username:
+                with SMTP_PHASE_SECONDS.labels('login').time():
+                    await smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    @staticmethod
+    def _should_reconnect(exc):
+        if isinstance(exc, aiosmtplib.SMTPServerDisconnected):
+            return True
+        return isinstance(exc, aiosmtplib.SMTPResponseException) and exc.code in RECONNECT_CODES
+
+    async def send(self, recipients, msg, retries=2):
+        async with self.slots:
+            await self.bucket.acquire()
+            for attempt in range(retries + 1):
+                smtp = self.idle.pop() if self.idle else await self._connect()
+                try:
+                    with SMTP_PHASE_SECONDS.labels('send').time():
+                        await smtp.sendmail(self.username, recipients, msg)
+                except Exception as exc:
+                    smtp.close()
+                    if attempt < retries and self._should_reconnect(exc):
+                        continue
+                    raise
+                self.idle.append(smtp)
+                return
+
+    async def close(self):
+        while self.idle:
+            smtp = self.idle.pop()
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+
+async def send_all(invoices, concurrency=None, rate_per_minute=None, workers=None, start_tls=STARTTLS):
+    """
+    Send every invoice (send_invoice kwargs) from a sync iterator.
+
+    Returns a dict with "sent" and "failed" counts.
+    """
+    concurrency = concurrency or DEFAULT_CONCURRENCY
+    rate_per_minute = rate_per_minute or DEFAULT_RATE_PER_MINUTE
+    workers = workers or DEFAULT_WORKERS
+
+    queue = asyncio.Queue(maxsize=workers * QUEUE_SIZE_PER_WORKER)
+    accounts = {}
+    stats = {"sent": 0, "failed": 0}
+
+    loop = asyncio.get_running_loop()
+    # One thread, since the iterator's stages aren't safe to advance from several
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="invoice-reader")
+
+    async def deliver(invoice):
+        server = invoice.get("smtp_server", SMTP_SERVER)
+        port = invoice.get("smtp_port", SMTP_PORT)
+        key = (server, port, invoice["sender_email"])
+        account = accounts.get(key)
+        if account is None:
+            account = accounts[key] = SenderAccount(
+                server, port, invoice["sender_email"], invoice["sender_password"],
+                concurrency, rate_per_minute, start_tls=start_tls
+            )
+
+        # Already rendered by process_clients' render stage, or built here
+        recipients, msg = invoice.get("rendered") or await loop.run_in_executor(
+            reader, lambda: build_invoice(
+                invoice["email"], invoice["name"], invoice["cc"], invoice["cost"],
+                invoice["message"], invoice["sender_email"], invoice["late_fee_note"],
+                invoice["grace_deadline"], invoice["late_fee_amount"], invoice["occupancy_days"],
+                attachments=invoice.get("attachments", ())
+            )
+        )
+        try:
+            await account.send(recipients, msg)
+        except Exception as e:
+            stats["failed"] += 1
+            record_send(None, False)
+            invoice_log.error("❌ Failed to send invoice to %s: %s", redact(invoice['email']), e)
+        else:
+            stats["sent"] += 1
+            record_send(None, True)
+            invoice_log.info("✅ Invoice sent to %s", redact(invoice['email']))
+
+    async def consume():
+        while True:
+            invoice = await queue.get()
+            try:
+                if invoice is None:
+                    return
+                await deliver(invoice)
+            finally:
+                queue.task_done()
+
+    async def produce():
+        # put() blocks while the queue is full, pausing the CSV reader
+        it = iter(invoices)
+        done = object()
+        while True:
+            invoice = await loop.run_in_executor(reader, next, it, done)
+            if invoice is done:
+                break
+            await queue.put(invoice)
+        for _ in range(workers):
+            await queue.put(None)
+
+    try:
+        await asyncio.gather(produce(), *(consume() for _ in range(workers)))
+    finally:
+        reader.shutdown(wait=False)
+        for account in accounts.values():
+            await account.close()
+    return stats
@@ -0,0 +1,87 @@
+"""
+Invoice status for 100k clients: a per-row fee_schedule loop (what the
+routes used to do client by client) versus one vectorized invoice_engine pass.
+
+    python -m benchmarks.bench_invoice_engine --clients 100000
+
+Before timing, it checks that the engine agrees with fee_schedule on every
+row. It also checks that the engine matches the pre-engine formula on the
+rows where invoice_engine's docstring says the behavior is unchanged.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from fee_schedule import build_schedule, schedule_for
+from invoice_engine import compute_invoice_status
+
+
+def per_row(columns, now):
+    results = []
+    for cost, grace_period, duration, late_fee, send_day in zip(*columns):
+        schedule = schedule_for(cost, grace_period, duration, late_fee, send_day, now)
+        results.append((schedule.amount_at(now), schedule.grace_deadline, schedule.is_overdue(now)))
+    return results
+
+
+def old_status(cost, grace_period, send_day, now):
+    """(final cost, grace deadline, overdue) as the old get_invoice_status_for_client had them"""
+    invoice_sent_date = datetime(now.year, now.month, min(send_day, 28))
+    if now.day > send_day:
+        year, month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
+        invoice_sent_date = datetime(year, month, min(send_day, 28))
+    grace_deadline = invoice_sent_date + timedelta(days=grace_period, hours=23, minutes=59)
+    return float(cost), grace_deadline, now > grace_deadline
+
+
+def check(columns, now, status):
+    """Raise AssertionError where the engine disagrees with fee_schedule or the old formula"""
+    cost, grace_period, duration, late_fee, send_day = [c.tolist() for c in columns]
+    deadlines = status['grace_deadline'].astype('datetime64[s]').tolist()
+    for i, (amount, deadline, overdue) in enumerate(per_row([cost, grace_period, duration, late_fee, send_day], now)):
+        assert abs(status['final_cost'][i] - amount) < 1e-6, (i, status['final_cost'][i], amount)
+        assert deadlines[i] == deadline, (i, deadlines[i], deadline)
+        assert bool(status['is_overdue'][i]) == overdue, i
+
+    unchanged = [i for i, day in enumerate(send_day) if day == now.day <= 28]
+    for i in unchanged:
+        assert (status['final_cost'][i], deadlines[i], bool(status['is_overdue'][i])) == \
+            old_status(cost[i], grace_period[i], send_day[i], now), i
+    return len(unchanged)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n = args.clients
+    columns = (
+        rng.uniform(50, 500, n),        # cost
+        rng.integers(0, 30, n),         # grace_period
+        rng.integers(1, 8, n),          # duration
+        rng.uniform(0, 100, n),         # late_fee
+        rng.integers(1, 32, n),         # send_day
+    )
+    now = datetime.now()
+    unchanged = check(columns, now, compute_invoice_status(*columns, now=now))
+    build_schedule.cache_clear()  # Time the loop cold, as before the check
+
+    start = time.perf_counter()
+    per_row([c.tolist() for c in columns], now)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compute_invoice_status(*columns, now=now)
+    vector_time = time.perf_counter() - start
+
+    print(f"clients:    {n} (all match fee_schedule, {unchanged} on their send day match the old formula)")
+    print(f"per-row:    {loop_time * 1000:9.1f} ms")
+    print(f"vectorized: {vector_time * 1000:9.1f} ms ({loop_time / vector_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
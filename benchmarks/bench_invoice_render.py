@@ -0,0 +1,80 @@
+"""
+Render-plus-serialize throughput for invoice emails: a new MIMEMultipart per
+invoice serialized with as_string (what build_invoice used to do) versus the
+compiled template and cached MIME skeleton in invoice_templates.
+
+    python -m benchmarks.bench_invoice_render --invoices 100000
+"""
+import argparse
+import time
+from datetime import datetime
+from email import policy
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from invoice_templates import DEFAULT_SUBJECT, DEFAULT_TEXT, compile_template
+from main import build_invoice, clean_hard
+
+HTML = "<p>Hello {{ name }},</p><p>Total due: <b>${{ cost|money }}</b></p>"
+
+
+def build_mime(email, name, cc, cost, message, sender_email, late_fee_note, grace_deadline, late_fee_amount, occupancy_days):
+    name = clean_hard(name)
+    message = clean_hard(message)
+    late_fee_note = clean_hard(late_fee_note)
+    body_message = f"Hello {name},\n\n"
+    if message:
+        body_message += f"{message}\n\n"
+    full_message = body_message + f"""\
+Total due: ${cost:.2f}
+Last day before Late fees: {grace_deadline.strftime('%Y-%m-%d %H:%M:%S')}
+Late Fee of ${late_fee_amount:.2f} will be applied every {occupancy_days} day(s) from that date.
+{late_fee_note}
+
+Thank you,
+GUK IL KIM
+"""
+    msg = MIMEMultipart(policy=policy.SMTPUTF8)
+    msg['From'] = sender_email
+    msg['To'] = email
+    msg['Subject'] = f"Monthly Invoice - {datetime.now().strftime('%B %Y')}"
+    if cc:
+        msg['Cc'] = cc
+    msg.attach(MIMEText(full_message, 'plain', 'utf-8'))
+    recipients = [email] + ([cc] if cc else [])
+    return recipients, msg.as_string(policy=policy.SMTPUTF8)
+
+
+def invoices(count):
+    deadline = datetime(2026, 1, 4, 23, 59)
+    for i in range(count):
+        yield (f"client{i}@example.com", f"Client {i}", "" if i % 3 else f"cc{i}@example.com",
+               100.0 + i % 400, "Thanks for your business.", "billing@example.com",
+               "", deadline, 50.0, 1 + i % 7)
+
+
+def run(label, render, count):
+    start = time.perf_counter()
+    size = 0
+    for invoice in invoices(count):
+        size += len(render(*invoice)[1])
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {count / elapsed:10.0f} invoices/s  ({elapsed:.1f} s, {size / count:.0f} bytes avg)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=100_000)
+    args = parser.parse_args()
+
+    html_template = compile_template(DEFAULT_SUBJECT, DEFAULT_TEXT, HTML)
+
+    mime = run("MIMEMultipart", build_mime, args.invoices)
+    text = run("template (text)", build_invoice, args.invoices)
+    run("template (text+html)", lambda *invoice: build_invoice(*invoice, template=html_template), args.invoices)
+    print(f"speedup (text): {mime / text:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Query plans and timings for each route's queries against a seeded database
+of 1M clients, with the migrated indexes and again without them.
+
+    python -m benchmarks.bench_queries --clients 1000000 --users 1000
+
+Uses a throwaway SQLite file unless DATABASE_URL is set; the database is
+seeded once and reused on later runs.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bench_queries.db'))
+
+from sqlalchemy import event, text  # noqa: E402
+
+from app import app, db, Client, Revenue, SendCalendar, User  # noqa: E402
+from client_queries import dashboard_summary, list_clients  # noqa: E402
+from send_calendar import due_page, fill  # noqa: E402
+
+CHUNK = 50_000
+
+
+def seed(clients, users):
+    if Client.query.count() >= clients:
+        return
+    print(f"Seeding {clients} clients for {users} users...")
+    rng = random.Random(0)
+    db.session.execute(User.__table__.insert(), [
+        {'id': u, 'email': f'user{u}@example.com', 'smtp_server': 'smtp.example.com', 'smtp_port': 587}
+        for u in range(1, users + 1)
+    ])
+    for start in range(0, clients, CHUNK):
+        rows = [{
+            'id': i + 1,
+            'email': f'client{i}@example.com',
+            'name': f'Client {rng.randrange(clients):07d}',
+            'cost': rng.uniform(50, 500),
+            'late_fee': rng.uniform(0, 100),
+            'grace_period': rng.randrange(0, 10),
+            'duration': rng.randrange(1, 8),
+            'send_day': rng.randrange(1, 32),
+            'send_hour': 9,
+            'user_id': i % users + 1,
+            'is_paid': rng.random() < 0.4,
+        } for i in range(start, min(start + CHUNK, clients))]
+        db.session.execute(Client.__table__.insert(), rows)
+        db.session.execute(Revenue.__table__.insert(), [
+            {'amount': row['cost'], 'client_id': row['id'], 'user_id': row['user_id'],
+             'payment_date': datetime(2026, rng.randrange(1, 13), rng.randrange(1, 29), 12)}
+            for row in rows if row['is_paid']
+        ])
+        db.session.commit()
+    fill(now=datetime(2026, 1, 1))
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def route_queries(user_id):
+    """(route, description, callable running the route's query)"""
+    return [
+        ('add_client', 'duplicate email check', lambda: Client.query.filter_by(
+            email='new.client@example.com', user_id=user_id).first()),
+        ('dashboard', 'first page by name', lambda: list_clients(user_id)),
+        ('dashboard', 'summary aggregates', lambda: dashboard_summary(user_id)),
+        ('view_clients', 'unpaid, by name', lambda: list_clients(user_id, is_paid=False)),
+        ('view_clients', 'overdue, by send day', lambda: list_clients(user_id, sort='send_day', is_overdue=True)),
+        ('view_clients', 'send day 15', lambda: list_clients(user_id, send_day=15)),
+        ('toggle_payment_status', 'revenue to undo', lambda: Revenue.query.filter_by(client_id=user_id * 7).all()),
+        ('dispatch_due', 'calendar page due by the 15th', lambda: due_page(datetime(2026, 1, 15, 9), (user_id, 0))),
+    ]
+
+
+def query_plans(run):
+    """EXPLAIN output for every statement `run` executes"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        run()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    plans = []
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            if db.engine.dialect.name == 'sqlite':
+                rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plans.append([row[-1] for row in rows])
+            else:
+                rows = conn.exec_driver_sql('EXPLAIN ' + statement, parameters)
+                plans.append([row[0] for row in rows])
+    return plans
+
+
+def timed(run, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.expire_all()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(title, queries, repeat):
+    print(f"\n=== {title} ===")
+    for route, description, run in queries:
+        elapsed = timed(run, repeat)
+        print(f"\n{route}: {description}  {elapsed * 1000:.2f} ms")
+        for plan in query_plans(run):
+            for line in plan:
+                print(f"    {line}")
+
+
+def secondary_indexes():
+    return [index for model in (Client, Revenue, SendCalendar) for index in model.__table__.indexes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.clients, args.users)
+        queries = route_queries(user_id=args.users // 2)
+        report("With indexes", queries, args.repeat)
+
+        for index in secondary_indexes():
+            index.drop(db.engine, checkfirst=True)
+        try:
+            report("Without indexes", queries, args.repeat)
+        finally:
+            for index in secondary_indexes():
+                index.create(db.engine, checkfirst=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+End-to-end load test of the invoice send path against a local SMTP sink.
+
+    python -m benchmarks.bench_send_path --clients 2000 --latency 0.02 --throttle-rate 0.01
+    python -m benchmarks.bench_send_path --scenarios csv-async --output bench.jsonl
+
+Scenarios, each in a fresh process so peak RSS is its own:
+
+    csv-sync    main.process_clients over a seeded clients.csv
+    csv-async   the same with mode="async"
+    db          app.send_invoice_email for every seeded Client
+    dispatch    app.dispatch_due for the tick the seeded clients' invoices fall due
+
+Prints one JSON object with throughput, p50/p99 latency per invoice and peak
+RSS for every scenario; --output appends it as a line to a file, so runs can
+be compared over time. Latency is measured around one send_rendered call,
+SenderAccount.send, send_invoice_email call or outbox delivery respectively.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, time as day_time
+
+from benchmarks.smtp_sink import SMTPSink
+
+SCENARIOS = ("csv-sync", "csv-async", "db", "dispatch")
+CSV_FIELDS = ("email", "name", "cc", "cost", "message", "late_fee", "grace_period", "duration", "send_day", "send_hour")
+
+
+def client_row(i, today):
+    # No grace period and a fee every day, so the CSV script finds a reminder
+    # due for every row on any day of the month
+    return {
+        "email": f"client{i}@example.com", "name": f"Client {i}", "cc": "" if i % 5 else f"cc{i}@example.com",
+        "cost": 100.0 + i % 400, "message": "Thanks for your business.", "late_fee": 50.0,
+        "grace_period": 0, "duration": 1, "send_day": today.day, "send_hour": 9,
+    }
+
+
+def timed(samples, func):
+    """Wrap func (sync or async) to append its duration to samples"""
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_csv(workdir, clients, mode, samples):
+    import async_sender
+    import main
+
+    today = datetime.now()
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    with open(os.path.join(workdir, "data", "user.csv"), "w", newline="") as f:
+        f.write("email,password\nbench@example.com,secret\n")
+    path = os.path.join(workdir, "data", "clients.csv")
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(client_row(i, today) for i in range(clients))
+
+    main.send_rendered = timed(samples, main.send_rendered)
+    async_sender.SenderAccount.send = timed(samples, async_sender.SenderAccount.send)
+    os.chdir(workdir)  # process_clients reads data/user.csv
+    start = time.perf_counter()
+    main.process_clients(path, mode=mode)
+    return time.perf_counter() - start
+
+
+def seed_db(clients, port):
+    from app import app, db, Client, User
+
+    today = datetime.now()
+    with app.app_context():
+        user = User(email="bench@example.com", smtp_server="127.0.0.1", smtp_port=port,
+                    smtp_username="bench@example.com", smtp_password="secret")
+        db.session.add(user)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Client, [
+            dict(client_row(i, today), user_id=user.id, created_at=today) for i in range(clients)
+        ])
+        db.session.commit()
+        return [client_id for client_id, in db.session.query(Client.id)], today.day
+
+
+def run_db(clients, port, samples):
+    import app as web
+
+    client_ids, _ = seed_db(clients, port)
+    send = timed(samples, web.send_invoice_email)
+    start = time.perf_counter()
+    with web.app.app_context():
+        for client_id in client_ids:
+            send(client_id)
+    return time.perf_counter() - start
+
+
+def run_dispatch(clients, port, samples):
+    import app as web
+    import outbox
+
+    import send_calendar
+
+    seed_db(clients, port)
+    # Calendar entries as of midnight, so every client falls due at 09:00 today
+    midnight = datetime.combine(datetime.now().date(), day_time())
+    with web.app.app_context():
+        send_calendar.fill(now=midnight)
+        web.db.session.commit()
+    outbox.deliver = timed(samples, outbox.deliver)
+    start = time.perf_counter()
+    web.dispatch_due(midnight.replace(hour=9))
+    return time.perf_counter() - start
+
+
+def run_scenario(name, options, port, results):
+    """Child process entry point: configure, run, report through `results`"""
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.environ.update({
+        "SMTP_SERVER": "127.0.0.1", "SMTP_PORT": str(port), "SMTP_STARTTLS": "0",
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "bench.db"),
+        "INVOICE_PDF": "1" if options["pdf"] else "0",
+        "ASYNC_SMTP_RATE_PER_MINUTE": str(options["rate_per_minute"]),
+        "LOG_LEVEL": "WARNING",
+    })
+
+    import invoice_pdf
+
+    samples = []
+    try:
+        if name in ("csv-sync", "csv-async"):
+            elapsed = run_csv(workdir, options["clients"], name.split("-")[1], samples)
+        elif name == "db":
+            elapsed = run_db(options["clients"], port, samples)
+        else:
+            elapsed = run_dispatch(options["clients"], port, samples)
+    finally:
+        # atexit doesn't run in multiprocessing children; a live PDF pool would keep this one from exiting
+        invoice_pdf.shutdown()
+
+    results.put({"elapsed": elapsed, "samples": samples,
+                 "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def percentile(samples, q):
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+def measure(name, options):
+    sink = SMTPSink(latency=options["latency"], error_rate=options["error_rate"],
+                    throttle_rate=options["throttle_rate"], seed=0).start()
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=run_scenario, args=(name, options, sink.port, results))
+    try:
+        process.start()
+        outcome = results.get()
+        process.join()
+    finally:
+        sink.stop()
+
+    samples = outcome["samples"]
+    return {
+        "scenario": name,
+        "invoices": len(samples),
+        "accepted": sink.messages,
+        "rejected": sink.rejected,
+        "throttled": sink.throttled,
+        "seconds": round(outcome["elapsed"], 3),
+        "throughput_per_s": round(sink.messages / outcome["elapsed"], 1),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "peak_rss_mb": round(outcome["peak_rss_mb"], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="sink delay per message, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of messages rejected with 554")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction answered 421 and disconnected")
+    parser.add_argument("--rate-per-minute", type=float, default=1_000_000, help="async sender rate limit")
+    parser.add_argument("--pdf", action="store_true", help="attach PDF invoices")
+    parser.add_argument("--output", help="append the JSON result as one line to this file")
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in
+               ("clients", "latency", "error_rate", "throttle_rate", "rate_per_minute", "pdf")}
+    report = {
+        "benchmark": "send_path",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "options": options,
+        "results": [],
+    }
+    for name in args.scenarios:
+        result = measure(name, options)
+        report["results"].append(result)
+        print(f"{name:>10}: {result['throughput_per_s']:8.1f} msg/s  p50 {result['p50_ms']:.1f} ms  "
+              f"p99 {result['p99_ms']:.1f} ms  {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(report) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Messages per second through main.send_invoice's transport, with and without
+the SMTP connection pool, against a local sink.
+
+    python -m benchmarks.bench_smtp_pool --messages 2000
+"""
+import argparse
+import smtplib
+import time
+
+from benchmarks.smtp_sink import SMTPSink
+from smtp_pool import SMTPConnectionPool
+
+MESSAGE = "Subject: Monthly Invoice\r\n\r\nTotal due: $100.00\r\n"
+
+
+def send_unpooled(port, count):
+    # What send_invoice did before the pool: connect, login, send, quit
+    for _ in range(count):
+        with smtplib.SMTP("127.0.0.1", port) as server:
+            server.login("bench@example.com", "secret")
+            server.sendmail("bench@example.com", ["client@example.com"], MESSAGE)
+
+
+def send_pooled(port, count):
+    pool = SMTPConnectionPool(starttls=False)
+    for _ in range(count):
+        pool.sendmail("127.0.0.1", port, "bench@example.com", "secret",
+                      "bench@example.com", ["client@example.com"], MESSAGE)
+    pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    args = parser.parse_args()
+
+    sink = SMTPSink().start()
+    try:
+        for label, runner in (("unpooled", send_unpooled), ("pooled", send_pooled)):
+            start = time.perf_counter()
+            runner(sink.port, args.messages)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>9}: {args.messages / elapsed:10.1f} msg/s ({elapsed:.2f}s)")
+    finally:
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Minimal local SMTP sink used by the benchmarks.
+
+Speaks just enough ESMTP (EHLO, AUTH PLAIN, MAIL, RCPT, DATA, NOOP, RSET,
+QUIT) for smtplib to deliver to it, and throws every message away. No TLS, so
+point the SMTP pool at it with starttls=False (SMTP_STARTTLS=0).
+
+To look more like a real provider it can also:
+
+    latency        seconds to wait before accepting each message
+    error_rate     fraction of messages rejected with 554 (permanent)
+    throttle_rate  fraction answered 421 and disconnected, like Gmail's
+                   per-account rate limiting
+"""
+import random
+import socketserver
+import threading
+import time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-localhost\r\n250-AUTH PLAIN\r\n"
+                                 b"250-8BITMIME\r\n250 SMTPUTF8\r\n")
+            elif verb == "AUTH":
+                # Any credentials are accepted; PLAIN may arrive without an
+                # initial response, in which case we prompt for it
+                if len(command.split()) == 2:
+                    self.reply("334 ")
+                    self.rfile.readline()
+                self.reply("235 Authentication successful")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                outcome = self.server.accept_message()
+                if outcome == "throttled":
+                    self.reply("421 4.7.0 Try again later, closing connection")
+                    return
+                if outcome == "rejected":
+                    self.reply("554 5.7.1 Message rejected")
+                else:
+                    self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # MAIL, RCPT, RSET and NOOP all just succeed
+                self.reply("250 OK")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=None):
+        super().__init__((host, port), _SMTPHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.messages = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._count_lock = threading.Lock()
+
+    def accept_message(self):
+        """Decide one message's fate: "accepted", "rejected" or "throttled"."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._count_lock:
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                return "throttled"
+            if roll < self.throttle_rate + self.error_rate:
+                self.rejected += 1
+                return "rejected"
+            self.messages += 1
+            return "accepted"
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
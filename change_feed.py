@@ -0,0 +1,148 @@
+"""
+Incremental invoice status changes for the dashboard and integrations.
+
+Every change to a client or its payments is logged in ChangeLog under the
+owner's new data_version (see app.log_changes). Bumping that version locks
+the user's row until the change commits, so a user's changes commit in seq
+order and a reader that has seen seq n only ever needs rows after n.
+
+    GET /api/invoices/changes?since=<seq>    one delta as JSON
+    GET /api/invoices/stream?since=<seq>     the same deltas as Server-Sent Events
+
+The dashboard polls the JSON endpoint every CHANGE_POLL_SECONDS. A stream
+holds a web worker while it is open, so it is only served with
+CHANGE_STREAM=1, for servers with threaded or gevent workers, and each
+process serves at most CHANGE_STREAMS_PER_USER streams per user.
+
+A delta carries the current status of each changed client (or just its id
+when deleted), the dashboard totals and the new `seq` to pass back. When the
+log no longer reaches back to `since`, or too much changed, it has
+`reset: true` and the client should reload in full. `epoch` changes when
+late fees step up without any write, which also calls for a reload.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app import db, Client, ChangeLog, User
+import client_cache
+from client_queries import dashboard_summary, status_json
+from fee_schedule import boundary_epoch
+from invoice_engine import invoice_statuses
+
+# More changed clients than this in one delta: reload instead
+MAX_CHANGES = int(os.getenv('CHANGE_FEED_MAX_CHANGES', 500))
+RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', 7))
+POLL_INTERVAL = float(os.getenv('CHANGE_STREAM_POLL_INTERVAL', 1))
+# Streams end after this long and EventSource reconnects, so one connection
+# doesn't hold a web worker indefinitely
+STREAM_SECONDS = int(os.getenv('CHANGE_STREAM_SECONDS', 300))
+HEARTBEAT_SECONDS = 15
+STREAM_ENABLED = os.getenv('CHANGE_STREAM', '0').lower() not in ('0', 'false', 'no', '')
+MAX_STREAMS_PER_USER = int(os.getenv('CHANGE_STREAMS_PER_USER', 2))
+POLL_SECONDS = int(os.getenv('CHANGE_POLL_SECONDS', 30))
+
+_open_streams = {}  # user id -> streams open in this process
+_streams_lock = threading.Lock()
+
+
+def parse_since(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def changes_since(user_id, since):
+    """The delta for a user's changes after seq `since`"""
+    version = db.session.query(User.data_version).filter(User.id == user_id).scalar() or 0
+    epoch = list(boundary_epoch())
+    if since is None or since > version:
+        return {'seq': version, 'epoch': epoch, 'reset': True}
+    if since == version:
+        return {'seq': version, 'epoch': epoch, 'reset': False, 'changes': []}
+
+    first = db.session.query(db.func.min(ChangeLog.seq)).filter(ChangeLog.user_id == user_id).scalar()
+    if first is None or first > since + 1:
+        # Pruned, or from before the log existed
+        return {'seq': version, 'epoch': epoch, 'reset': True}
+
+    rows = db.session.query(ChangeLog.seq, ChangeLog.client_id, ChangeLog.op) \
+        .filter(ChangeLog.user_id == user_id, ChangeLog.seq > since) \
+        .order_by(ChangeLog.seq, ChangeLog.id).limit(MAX_CHANGES + 1).all()
+    if len(rows) > MAX_CHANGES:
+        return {'seq': version, 'epoch': epoch, 'reset': True}
+
+    # Changes committed after `version` was read are included too; seq
+    # reports how far this delta actually goes
+    latest = {}
+    for seq, client_id, op in rows:
+        latest.pop(client_id, None)
+        latest[client_id] = (seq, op)
+    seq = max([version] + [seq for seq, _ in latest.values()])
+
+    clients = Client.query.filter(Client.user_id == user_id, Client.id.in_(list(latest))).all()
+    statuses = {status['id']: status for status in invoice_statuses(clients)}
+    changes = []
+    for client_id, (change_seq, op) in latest.items():
+        if client_id in statuses:
+            changes.append({'seq': change_seq, 'op': 'upsert', 'client': status_json(statuses[client_id])})
+        else:
+            changes.append({'seq': change_seq, 'op': 'delete', 'id': client_id})
+
+    totals = client_cache.clients.get(user_id, ('summary', (user_id, seq, boundary_epoch())),
+                                      lambda: dashboard_summary(user_id))
+    return {'seq': seq, 'epoch': epoch, 'reset': False, 'changes': changes, 'totals': totals}
+
+
+def claim_stream(user_id):
+    """Count a new stream for the user, or False if they already have MAX_STREAMS_PER_USER open here"""
+    with _streams_lock:
+        if _open_streams.get(user_id, 0) >= MAX_STREAMS_PER_USER:
+            return False
+        _open_streams[user_id] = _open_streams.get(user_id, 0) + 1
+        return True
+
+
+def release_stream(user_id):
+    with _streams_lock:
+        count = _open_streams.pop(user_id, 0) - 1
+        if count > 0:
+            _open_streams[user_id] = count
+
+
+def stream(user_id, since, poll_interval=POLL_INTERVAL, duration=STREAM_SECONDS):
+    """
+    Server-Sent Events: a `delta` event whenever the user's data_version or
+    the fee epoch moves past what was last sent, and a comment line as a
+    heartbeat. Event ids are seqs, so a reconnecting EventSource resumes
+    through Last-Event-ID.
+    """
+    yield "retry: 3000\n\n"
+    epoch = list(boundary_epoch())
+    deadline = time.monotonic() + duration
+    last_write = time.monotonic()
+    while time.monotonic() < deadline:
+        version = db.session.query(User.data_version).filter(User.id == user_id).scalar() or 0
+        if since is None or version != since or list(boundary_epoch()) != epoch:
+            delta = changes_since(user_id, since)
+            since, epoch = delta['seq'], delta['epoch']
+            yield f"id: {since}\nevent: delta\ndata: {json.dumps(delta)}\n\n"
+            last_write = time.monotonic()
+        elif time.monotonic() - last_write >= HEARTBEAT_SECONDS:
+            yield ": keepalive\n\n"
+            last_write = time.monotonic()
+        # End the transaction so the next poll sees new commits, and give
+        # the connection back to the pool while sleeping
+        db.session.rollback()
+        time.sleep(poll_interval)
+
+
+def prune(now=None):
+    """Delete change log rows older than RETENTION_DAYS. Returns the number deleted."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=RETENTION_DAYS)
+    deleted = ChangeLog.query.filter(ChangeLog.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
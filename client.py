@@ -1,8 +1,13 @@
 import csv
+import logging
 import os
 import sys
 from pathlib import Path
 
+from log_config import redact, setup_logging
+
+logger = logging.getLogger(__name__)
+
 # UTF-safe
 def clean(text):
     if not text:
@@ -46,7 +51,7 @@ def add_client_to_database(client, filename="clients.csv"):
         if not file_exists:
             writer.writeheader()
         writer.writerow(client)
-    print(f"\n✅ Client '{client['name']}' added to {filename}")
+    logger.info("✅ Client %s added to %s", redact(client['email']), filename)
 
 def cron_job(email, send_day, send_hour):
     # Get paths dynamically
@@ -58,7 +63,7 @@ def cron_job(email, send_day, send_hour):
 
     current_cron = os.popen("crontab -l").read()
     if cron_line in current_cron:
-        print("⚠️ Cron job already exists.")
+        logger.warning("⚠️ Cron job already exists.")
         return
 
     updated_cron = current_cron.strip() + f"\n{cron_line}\n"
@@ -68,9 +73,10 @@ def cron_job(email, send_day, send_hour):
 
     os.system("crontab temp_cron.txt")
     os.remove("temp_cron.txt")
-    print(f"✅ Cron job added for {email} on day {send_day} at {send_hour}:00.")
+    logger.info("✅ Cron job added for %s on day %s at %s:00.", redact(email), send_day, send_hour)
 
 if __name__ == "__main__":
+    setup_logging()
     client = collect_client_info()
     add_client_to_database(client)
     cron_job(client["email"], client["send_day"], client["send_hour"])
\ No newline at end of file
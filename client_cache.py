@@ -0,0 +1,108 @@
+"""
+Process-wide cache of per-user client snapshots.
+
+Dashboard and client list pages (invoice statuses, the next-page cursor and
+the dashboard totals) are cached per user and page options. Entries expire
+after CLIENT_CACHE_TTL seconds, since overdue status and late fees move with
+the clock, and the least recently used ones are evicted beyond
+CLIENT_CACHE_SIZE entries.
+
+The app's keys include the user's data_version and fee-schedule epoch (see
+app.page_version), so a change made by any process, or a late fee falling
+due, moves pages to new keys. Writes in this process also call
+invalidate(user_id) to free the old entries right away; elsewhere they age
+out through the TTL and LRU.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_REQUESTS
+
+TTL = float(os.getenv('CLIENT_CACHE_TTL', 30))
+MAX_SIZE = int(os.getenv('CLIENT_CACHE_SIZE', 1024))
+
+
+class SnapshotCache:
+    """
+    TTL + LRU cache whose keys belong to groups (a user id) that are
+    invalidated together. Counts hits, misses, evictions and invalidations.
+    """
+
+    def __init__(self, name, ttl=TTL, max_size=MAX_SIZE, clock=time.monotonic):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._entries = OrderedDict()  # (group, key) -> (expires_at, value), oldest use first
+        self._groups = {}  # group -> set of (group, key)
+        self._generations = {}  # group -> count of invalidations
+        self._epoch = 0  # count of clear() calls
+        self._lock = threading.Lock()
+
+    def _drop(self, entry_key):
+        self._entries.pop(entry_key, None)
+        keys = self._groups.get(entry_key[0])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self._groups[entry_key[0]]
+
+    def get(self, group, key, compute):
+        """The cached value for (group, key), calling compute() to fill it on a miss"""
+        entry_key = (group, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                CACHE_REQUESTS.labels(self.name, 'hit').inc()
+                return entry[1]
+            self.misses += 1
+            generation = (self._epoch, self._generations.get(group, 0))
+        CACHE_REQUESTS.labels(self.name, 'miss').inc()
+
+        # Computed outside the lock so one slow query doesn't stall other users
+        value = compute()
+
+        with self._lock:
+            # An invalidation while we were computing means the value may
+            # predate the change: return it, but don't keep it
+            if (self._epoch, self._generations.get(group, 0)) == generation:
+                self._drop(entry_key)
+                self._entries[entry_key] = (self.clock() + self.ttl, value)
+                self._groups.setdefault(group, set()).add(entry_key)
+                while len(self._entries) > self.max_size:
+                    self._drop(next(iter(self._entries)))
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, group):
+        """Forget every entry of a group, e.g. after a user's clients change"""
+        with self._lock:
+            self._generations[group] = self._generations.get(group, 0) + 1
+            for entry_key in list(self._groups.get(group, ())):
+                self._drop(entry_key)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._groups.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+# Shared by the app's dashboard, view_clients and /api/clients
+clients = SnapshotCache('clients')
+
+
+def invalidate(user_id):
+    clients.invalidate(user_id)
@@ -0,0 +1,317 @@
+"""
+Bulk client import, shared by migrate_csv.py and the upload endpoint.
+
+Rows are streamed in batches. Each batch is validated, checked against the
+user's existing client emails with one query, and inserted with
+bulk_insert_mappings in a single transaction, instead of a lookup and an
+INSERT per row.
+
+Uploads are saved to UPLOAD_DIR and queued as ImportJob rows. The scheduler
+(worker.py, or run.py's embedded one) imports them, recording progress on
+the row for any web worker to report, so UPLOAD_DIR must be shared by the
+web app and the workers. A running job whose progress hasn't been saved for
+IMPORT_STALE_SECONDS died with its process and is marked failed.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+import client_cache
+from app import db, Client, ImportJob, log_changes
+from send_calendar import fill
+
+logger = logging.getLogger(__name__)
+
+# Kept under SQLite's 999 bound parameters for the email IN (...) lookup
+BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+MAX_ERRORS = 20  # Invalid rows reported back in detail; the rest are only counted
+UPLOAD_DIR = os.getenv('UPLOAD_DIR') or tempfile.gettempdir()
+UPLOAD_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+IMPORT_STALE_SECONDS = int(os.getenv('IMPORT_STALE_SECONDS', 600))
+
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _text(row, key):
+    value = row.get(key)
+    return None if _blank(value) else str(value).strip()
+
+
+def _number(row, key, cast, default):
+    value = row.get(key)
+    return default if _blank(value) else cast(value)
+
+
+def _date(row, key):
+    value = _text(row, key)
+    return datetime.fromisoformat(value) if value else None
+
+
+def _bool(row, key):
+    value = row.get(key)
+    if isinstance(value, bool):
+        return value
+    return not _blank(value) and str(value).strip().lower() in ('1', 'true', 'yes', 'paid')
+
+
+def parse_row(row, user_id):
+    """
+    Column values for one client from a CSV/JSON row.
+
+    Accepts the columns of data/clients.csv (send_date, payment_status) as
+    well as the model's own names (send_day, is_paid). Raises ValueError for
+    a row that can't be imported.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("not a JSON object")
+    email, name = _text(row, 'email'), _text(row, 'name')
+    if not email or not name:
+        raise ValueError("email and name are required")
+    cost = _number(row, 'cost', float, None)
+    if cost is None:
+        raise ValueError("cost is required")
+
+    send_day = _number(row, 'send_day', int, None) or _number(row, 'send_date', int, 1)
+    if not 1 <= send_day <= 31:
+        raise ValueError(f"send day must be between 1 and 31, not {send_day}")
+    is_paid = _bool(row, 'is_paid') if 'is_paid' in row else _bool(row, 'payment_status')
+
+    return {
+        'email': email,
+        'name': name,
+        'cc': _text(row, 'cc'),
+        'cost': cost,
+        'message': _text(row, 'message'),
+        'late_fee': _number(row, 'late_fee', float, 50.0),
+        'grace_period': _number(row, 'grace_period', int, 3),
+        'duration': _number(row, 'duration', int, 1),
+        'send_day': send_day,
+        'send_hour': 9,  # Default to 9 AM
+        'user_id': user_id,
+        'created_at': _date(row, 'created_at') or datetime.utcnow(),
+        'is_paid': is_paid,
+        'payment_date': _date(row, 'payment_date') if is_paid else None,
+        'is_late': _bool(row, 'is_late'),
+    }
+
+
+def _log_inserted(user_id, rows):
+    inserted = and_(Client.user_id == user_id, Client.email.in_([row['email'] for row in rows]))
+    log_changes(inserted)
+    fill(inserted)
+
+
+def insert_batch(mappings, user_id):
+    """Insert clients whose email the user doesn't have yet. Returns the number inserted."""
+    wanted = {}
+    for mapping in mappings:
+        wanted.setdefault(mapping['email'], mapping)
+    if not wanted:
+        return 0
+
+    existing = {
+        email for email, in db.session.query(Client.email)
+        .filter(Client.user_id == user_id, Client.email.in_(list(wanted)))
+    }
+    rows = [mapping for email, mapping in wanted.items() if email not in existing]
+
+    if not rows:
+        return 0
+    try:
+        # The INSERT runs here, so a duplicate raises here rather than at commit
+        db.session.bulk_insert_mappings(Client, rows)
+        _log_inserted(user_id, rows)
+        db.session.commit()
+        return len(rows)
+    except IntegrityError:
+        # A client was added through the form in the meantime
+        db.session.rollback()
+
+    added = []
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.bulk_insert_mappings(Client, [row])
+            added.append(row)
+        except IntegrityError:
+            pass
+    if added:
+        _log_inserted(user_id, added)
+    db.session.commit()
+    return len(added)
+
+
+def import_clients(rows, user_id, batch_size=BATCH_SIZE, on_batch=None):
+    """
+    Import an iterable of row dicts for one user, batch by batch.
+
+    `on_batch(stats)` is called after every committed batch, e.g. to save a
+    checkpoint or report progress. Returns the final stats: rows read,
+    inserted, duplicates, invalid, errors (line and message for the first
+    MAX_ERRORS invalid rows), and rows_per_second.
+    """
+    stats = {'read': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'errors': [], 'rows_per_second': 0.0}
+    started = time.perf_counter()
+    rows = iter(rows)
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        mappings = []
+        for row in batch:
+            stats['read'] += 1
+            try:
+                mappings.append(parse_row(row, user_id))
+            except (ValueError, TypeError) as e:
+                stats['invalid'] += 1
+                if len(stats['errors']) < MAX_ERRORS:
+                    stats['errors'].append({'row': stats['read'], 'error': str(e)})
+
+        inserted = insert_batch(mappings, user_id)
+        stats['inserted'] += inserted
+        stats['duplicates'] += len(mappings) - inserted
+        stats['rows_per_second'] = stats['read'] / max(time.perf_counter() - started, 1e-9)
+        if on_batch:
+            on_batch(stats)
+
+    return stats
+
+
+def read_rows(raw, fmt):
+    """Row dicts streamed from a binary file; a bad JSON line yields None"""
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    try:
+        if fmt == 'csv':
+            yield from csv.DictReader(text)
+            return
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+    finally:
+        # Leave `raw` open for the caller's progress reporting
+        text.detach()
+
+
+def _record(job, stats):
+    job.rows_read = stats['read']
+    job.inserted = stats['inserted']
+    job.duplicates = stats['duplicates']
+    job.invalid = stats['invalid']
+    job.errors = json.dumps(stats['errors'])
+    job.rows_per_second = stats['rows_per_second']
+
+
+def _remove(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def run_import(job_id):
+    """Import a queued job's file, unless another worker claimed it first"""
+    claimed = ImportJob.query.filter_by(id=job_id, status='queued') \
+        .update({'status': 'running', 'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return
+    job = ImportJob.query.get(job_id)
+    try:
+        size = os.path.getsize(job.path) or 1
+        with open(job.path, 'rb') as raw:
+            def progress(stats):
+                # Read-ahead makes this run slightly early; close enough for a progress bar
+                job.progress = min(raw.tell() / size, 1.0)
+                job.heartbeat_at = datetime.utcnow()
+                _record(job, stats)
+                db.session.commit()
+                client_cache.invalidate(job.user_id)
+
+            stats = import_clients(read_rows(raw, job.format), job.user_id, on_batch=progress)
+        _record(job, stats)
+        client_cache.invalidate(job.user_id)
+        job.status = 'done'
+        job.progress = 1.0
+        logger.info("✅ Import %s: %d clients added (%.0f rows/s)", job_id, stats['inserted'], stats['rows_per_second'])
+    except Exception as e:
+        logger.exception("❌ Import %s failed", job_id)
+        db.session.rollback()
+        job.status = 'failed'
+        job.last_error = str(e)
+    finally:
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        _remove(job.path)
+
+
+def fail_stale_imports(now=None):
+    """Mark running jobs whose process died as failed. Returns how many."""
+    now = now or datetime.utcnow()
+    stale = ImportJob.query.filter(ImportJob.status == 'running',
+                                   ImportJob.heartbeat_at < now - timedelta(seconds=IMPORT_STALE_SECONDS)).all()
+    for job in stale:
+        logger.warning("⚠️ Import %s stopped making progress, marking it failed", job.id)
+        job.status = 'failed'
+        # Rows already imported are skipped as duplicates on a retry
+        job.last_error = 'Interrupted; upload the file again to import the remaining clients'
+        job.finished_at = now
+        _remove(job.path)
+    db.session.commit()
+    return len(stale)
+
+
+def run_queued_imports():
+    """Scheduler job: fail dead imports, then run queued ones oldest first"""
+    fail_stale_imports()
+    while True:
+        job = ImportJob.query.filter_by(status='queued').order_by(ImportJob.created_at).first()
+        if job is None:
+            return
+        run_import(job.id)
+
+
+def start_import(upload, user_id):
+    """Save an uploaded file and queue it for the scheduler to import. Returns the ImportJob."""
+    fmt = UPLOAD_FORMATS[os.path.splitext(upload.filename)[1].lower()]
+    fd, path = tempfile.mkstemp(prefix='clients-', suffix='.' + fmt, dir=UPLOAD_DIR)
+    os.close(fd)
+    upload.save(path)
+
+    job = ImportJob(id=uuid.uuid4().hex, user_id=user_id, filename=upload.filename, path=path, format=fmt)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def job_json(job):
+    return {
+        'job_id': job.id,
+        'filename': job.filename,
+        'status': job.status,
+        'progress': round(job.progress, 3),
+        'rows_read': job.rows_read,
+        'inserted': job.inserted,
+        'duplicates': job.duplicates,
+        'invalid': job.invalid,
+        'errors': json.loads(job.errors) if job.errors else [],
+        'rows_per_second': job.rows_per_second,
+        'last_error': job.last_error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,203 @@
+"""
+Paginated client listing for view_clients, the dashboard and /api/clients.
+
+Pages are keyset based: the cursor carries the sort it was made for and the
+last row's sort value and id, so fetching page 500 costs the same as page 1. Sorting and every filter,
+including "is overdue", run in SQL against the (user_id, ...) indexes.
+"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, tuple_
+
+from app import db, Client, Revenue
+from fee_schedule import GRACE_END_OF_DAY, period_start
+
+SORT_COLUMNS = {
+    'name': Client.name,
+    'email': Client.email,
+    'send_day': Client.send_day,
+    'cost': Client.cost,
+    'id': Client.id,
+}
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(sort, direction, value, client_id):
+    raw = json.dumps([sort, direction, value, client_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort, direction):
+    """
+    The (value, id) keyset position in `cursor`. Raises ValueError if it is
+    malformed or was made for another sort, whose values it can't be
+    compared with.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_direction, value, client_id = json.loads(base64.urlsafe_b64decode(padded))
+        client_id = int(client_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(value, (str, int, float)):
+        raise ValueError("Invalid cursor")
+    if (cursor_sort, cursor_direction) != (sort, direction):
+        raise ValueError("Cursor was made for a different sort; start again without `after`")
+    return value, client_id
+
+
+def _contains(text):
+    """An ILIKE pattern matching `text` literally, with escape='\\'"""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _parse_bool(value):
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_list_args(args):
+    """
+    List options from request.args, ignoring anything invalid except the
+    cursor: raises ValueError for one that doesn't belong to the sort.
+    """
+    sort = args.get('sort', 'name')
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    try:
+        send_day = int(args['send_day']) if args.get('send_day') else None
+    except ValueError:
+        send_day = None
+    options = {
+        'sort': sort if sort in SORT_COLUMNS else 'name',
+        'direction': 'desc' if args.get('direction') == 'desc' else 'asc',
+        'after': args.get('after') or None,
+        'limit': limit,
+        'name': args.get('name') or None,
+        'email': args.get('email') or None,
+        'is_paid': _parse_bool(args.get('is_paid')),
+        'is_overdue': _parse_bool(args.get('is_overdue')),
+        'send_day': send_day,
+    }
+    if options['after']:
+        decode_cursor(options['after'], options['sort'], options['direction'])
+    return options
+
+
+def list_clients(user_id, sort='name', direction='asc', after=None, limit=DEFAULT_PAGE_SIZE,
+                 name=None, email=None, is_paid=None, is_overdue=None, send_day=None, now=None):
+    """One page of a user's clients. Returns (clients, next_cursor or None)."""
+    column = SORT_COLUMNS[sort]
+    query = Client.query.filter(Client.user_id == user_id)
+
+    if name:
+        query = query.filter(Client.name.ilike(_contains(name), escape='\\'))
+    if email:
+        query = query.filter(Client.email.ilike(_contains(email), escape='\\'))
+    if is_paid is not None:
+        query = query.filter(Client.is_paid == is_paid)
+    if send_day is not None:
+        query = query.filter(Client.send_day == send_day)
+    if is_overdue is not None:
+        overdue = overdue_clause(now)
+        query = query.filter(overdue if is_overdue else ~overdue)
+
+    key = tuple_(column, Client.id)
+    if after:
+        cursor = decode_cursor(after, sort, direction)
+        query = query.filter(key < cursor if direction == 'desc' else key > cursor)
+    if direction == 'desc':
+        query = query.order_by(column.desc(), Client.id.desc())
+    else:
+        query = query.order_by(column, Client.id)
+
+    # One extra row tells us whether there is a next page
+    clients = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(clients) > limit:
+        clients = clients[:limit]
+        last = clients[-1]
+        next_cursor = encode_cursor(sort, direction, getattr(last, column.key), last.id)
+    return clients, next_cursor
+
+
+def _seconds_since_period_start(now):
+    return {day: int((now - period_start(day, now)).total_seconds()) for day in range(1, 32)}
+
+
+def overdue_clause(now=None):
+    """
+    SQL for "past the grace deadline of the current billing period".
+
+    The period start only depends on send_day, so for each possible send day
+    we precompute the seconds elapsed since it, and compare against the
+    client's grace period in SQL.
+    """
+    elapsed = case(_seconds_since_period_start(now or datetime.now()), value=Client.send_day)
+    return _grace_seconds() < elapsed
+
+
+def _grace_seconds():
+    return Client.grace_period * 86400 + int(GRACE_END_OF_DAY.total_seconds())
+
+
+def _month(column):
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+
+def dashboard_summary(user_id, now=None, months=12):
+    """
+    Dashboard counters from GROUP BY aggregates instead of loading clients.
+
+    total_revenue and revenue_by_month come from the Revenue ledger. pending,
+    late_fees and late_count are over unpaid clients, with late fees
+    computed in SQL using the same formula as fee_schedule.
+    """
+    now = now or datetime.now()
+    elapsed = case(_seconds_since_period_start(now), value=Client.send_day)
+    overdue = _grace_seconds() < elapsed
+    # Integer columns, so `/` is integer division on SQLite and Postgres:
+    # whole days past the deadline, then whole fee periods
+    fee_count = ((elapsed - _grace_seconds()) / 86400) / case((Client.duration < 1, 1), else_=Client.duration)
+    unpaid = Client.is_paid.isnot(True)
+    late = and_(unpaid, overdue)
+
+    pending_cost, late_fees, late_count = db.session.query(
+        func.coalesce(func.sum(case((unpaid, Client.cost), else_=0)), 0),
+        func.coalesce(func.sum(case((late, Client.late_fee * fee_count), else_=0)), 0),
+        func.coalesce(func.sum(case((late, 1), else_=0)), 0),
+    ).filter(Client.user_id == user_id).one()
+
+    total_revenue = db.session.query(func.coalesce(func.sum(Revenue.amount), 0)) \
+        .filter(Revenue.user_id == user_id).scalar()
+
+    # First day of the oldest month shown
+    year, month_index = divmod(now.year * 12 + now.month - months, 12)
+    since = datetime(year, month_index + 1, 1)
+    month = _month(Revenue.payment_date)
+    revenue_by_month = db.session.query(month, func.sum(Revenue.amount)) \
+        .filter(Revenue.user_id == user_id, Revenue.payment_date >= since) \
+        .group_by(month).order_by(month.desc()).limit(months).all()
+
+    return {
+        'total_revenue': float(total_revenue),
+        'pending': float(pending_cost) + float(late_fees),
+        'late_fees': float(late_fees),
+        'late_count': int(late_count),
+        'revenue_by_month': [(label, float(amount)) for label, amount in revenue_by_month],
+    }
+
+
+def status_json(status):
+    """A status dict from invoice_statuses with dates as ISO strings"""
+    return {key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in status.items()}
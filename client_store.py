@@ -0,0 +1,227 @@
+"""
+SQLite store behind the standalone dashboard (dashboard.py).
+
+Clients live in one table keyed by an integer id, in WAL mode, so readers
+never block the writer. Edits are single-row UPDATEs by primary key rather
+than rewriting a CSV. Read-modify-write changes such as the payment toggle
+run in BEGIN IMMEDIATE transactions, so concurrent writers queue on SQLite's
+write lock instead of overwriting each other.
+
+When the store is created it is filled from data/clients.csv if that
+exists. main.py then sends from the store (see rows()), so dashboard edits
+reach the next run. To get a CSV back:
+
+    python client_store.py --export data/clients.csv
+"""
+import csv
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+DB_PATH = os.getenv('DASHBOARD_DB', 'data/clients.sqlite3')
+CSV_PATH = 'data/clients.csv'
+
+COLUMNS = ('email', 'name', 'cc', 'cost', 'message', 'late_fee', 'grace_period', 'duration',
+           'send_date', 'payment_status', 'payment_date', 'is_late', 'created_at')
+DEFAULTS = {'cost': 0.0, 'late_fee': 50.0, 'grace_period': 3, 'duration': 1, 'send_date': 1,
+            'payment_status': 'Pending', 'is_late': 0}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cc TEXT,
+    cost REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    late_fee REAL NOT NULL DEFAULT 50,
+    grace_period INTEGER NOT NULL DEFAULT 3,
+    duration INTEGER NOT NULL DEFAULT 1,
+    send_date INTEGER NOT NULL DEFAULT 1,
+    payment_status TEXT NOT NULL DEFAULT 'Pending',
+    payment_date TEXT,
+    is_late INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_clients_name ON clients (name);
+CREATE INDEX IF NOT EXISTS ix_clients_email ON clients (email);
+-- One row: bumped by every write transaction, for the dashboard's ETags
+CREATE TABLE IF NOT EXISTS store_version (version INTEGER NOT NULL);
+INSERT INTO store_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM store_version);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+
+
+def connect(path=None):
+    """This thread's connection to the store, created (and the schema set up) on first use"""
+    path = path or DB_PATH
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # isolation_level=None: transactions are opened explicitly in transaction()
+        conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with _init_lock:
+            if path not in _initialized:
+                conn.executescript(SCHEMA)
+                # Version 0: nothing was ever written, so an empty table is a new
+                # store rather than one whose clients were all deleted
+                if os.path.exists(CSV_PATH) and not conn.execute('SELECT version FROM store_version').fetchone()[0]:
+                    import_csv(CSV_PATH, conn)
+                _initialized.add(path)
+        connections[path] = conn
+    return connections[path]
+
+
+@contextmanager
+def transaction(conn=None):
+    """
+    BEGIN IMMEDIATE ... COMMIT: takes the write lock up front, so reads
+    inside see no concurrent writes. Bumps the store version on commit.
+    """
+    conn = conn or connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('UPDATE store_version SET version = version + 1')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def version():
+    """Changes whenever any process commits a write to the store"""
+    return connect().execute('SELECT version FROM store_version').fetchone()[0]
+
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip()) or value != value  # NaN
+
+
+def _row(values):
+    """Column values for an INSERT, with defaults for missing ones"""
+    row = {column: None if _blank(values.get(column)) else values.get(column) for column in COLUMNS}
+    if row['send_date'] is None and not _blank(values.get('send_day')):
+        # client.py writes the column as send_day
+        row['send_date'] = values['send_day']
+    for column, default in DEFAULTS.items():
+        if row[column] is None:
+            row[column] = default
+    if isinstance(row['is_late'], str):
+        row['is_late'] = int(row['is_late'].strip().lower() in ('1', 'true', 'yes'))
+    row['created_at'] = str(row['created_at'] or datetime.now())
+    return row
+
+
+def import_csv(path, conn=None):
+    """Append every row of a clients CSV in one transaction. Returns the number imported."""
+    with open(path, newline='') as f:
+        rows = [_row(row) for row in csv.DictReader(f)]
+    with transaction(conn) as conn:
+        conn.executemany(
+            f"INSERT INTO clients ({', '.join(COLUMNS)}) VALUES ({', '.join(':' + c for c in COLUMNS)})", rows
+        )
+    return len(rows)
+
+
+def export_csv(path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in connect().execute(f"SELECT {', '.join(COLUMNS)} FROM clients ORDER BY id"):
+            writer.writerow(dict(row))
+
+
+def rows(path=None):
+    """(id, row) for every client, values as CSV-style strings, read in chunks for main.py"""
+    cursor = connect(path).execute(f"SELECT id, {', '.join(COLUMNS)} FROM clients ORDER BY id")
+    while True:
+        chunk = cursor.fetchmany(1000)
+        if not chunk:
+            return
+        for row in chunk:
+            yield row['id'], {column: '' if row[column] is None else str(row[column]) for column in COLUMNS}
+
+
+def all_clients():
+    return [dict(row) for row in connect().execute('SELECT * FROM clients ORDER BY id')]
+
+
+def get_client(client_id):
+    row = connect().execute('SELECT * FROM clients WHERE id = ?', (client_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def add_client(values):
+    """Insert a client and return its id"""
+    with transaction() as conn:
+        cursor = conn.execute(
+            f"INSERT INTO clients ({', '.join(COLUMNS)}) VALUES ({', '.join(':' + c for c in COLUMNS)})",
+            _row(values)
+        )
+    return cursor.lastrowid
+
+
+def update_client(client_id, values):
+    """Set the given columns of one client. Returns False if there is no such client."""
+    names = [column for column in values if column in COLUMNS]
+    with transaction() as conn:
+        cursor = conn.execute(
+            f"UPDATE clients SET {', '.join(f'{c} = :{c}' for c in names)} WHERE id = :id",
+            dict(values, id=client_id)
+        )
+    return cursor.rowcount > 0
+
+
+def delete_client(client_id):
+    with transaction() as conn:
+        conn.execute('DELETE FROM clients WHERE id = ?', (client_id,))
+
+
+def _parse_datetime(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+def toggle_payment(client_id, now=None):
+    """
+    Flip a client between Pending and Paid, recording the payment date and
+    whether it was late. Returns the new status, or None if there is no such client.
+    """
+    now = now or datetime.now()
+    with transaction() as conn:
+        row = conn.execute('SELECT payment_status, grace_period, created_at FROM clients WHERE id = ?',
+                           (client_id,)).fetchone()
+        if row is None:
+            return None
+        if row['payment_status'] == 'Pending':
+            deadline = _parse_datetime(row['created_at']) + timedelta(days=int(row['grace_period']))
+            values = ('Paid', str(now), int(now > deadline))
+        else:
+            values = ('Pending', None, 0)
+        conn.execute('UPDATE clients SET payment_status = ?, payment_date = ?, is_late = ? WHERE id = ?',
+                     values + (client_id,))
+    return values[0]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Dashboard client store")
+    parser.add_argument("--export", metavar="CSV", required=True, help="write every client to a CSV file for main.py")
+    args = parser.parse_args()
+
+    export_csv(args.export)
+    print(f"Exported clients to {args.export}")
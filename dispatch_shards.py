@@ -0,0 +1,149 @@
+"""
+Sharded invoice dispatch across worker nodes.
+
+With DISPATCH_SHARDS=n, the hourly dispatch tick doesn't queue everything
+the send calendar has due on the scheduler node. It records n DispatchShard
+rows for the tick instead; shard i holds the due entries of clients with
+id % n == i. Every node runs a ShardWorker that claims pending shards
+through a lease named after the shard and queues their invoices into the
+outbox, renewing the lease after each batch.
+
+Each batch's keyset position is saved on the shard row. If a node dies, its
+lease lapses after LEASE_TTL seconds and another node resumes the shard
+from the saved position. Outbox idempotency keys make re-queuing the batch
+that was in flight harmless.
+
+Ticks with nothing due record no shards, and finished shards are deleted a
+day after they finish.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, DispatchShard, SendCalendar
+from leases import acquire_lease, release_lease
+from outbox import billing_period, drain
+from send_calendar import dispatch, due_page
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5  # Seconds between looks for unclaimed shards
+DONE_RETENTION = timedelta(days=1)  # How long finished shards are kept
+
+
+def lease_name(shard):
+    return f"dispatch_shard:{shard.id}"
+
+
+def tick_of(shard):
+    year, month = map(int, shard.period.split('-'))
+    return datetime(year, month, shard.send_day, shard.send_hour)
+
+
+def start_run(tick, shards):
+    """
+    Create the pending shards of one hourly tick; a second call for the same
+    tick does nothing. Returns False if nothing is due by the tick.
+    """
+    prune_shards()
+    if db.session.query(SendCalendar.id).filter(SendCalendar.due_at <= tick).first() is None:
+        return False
+    for index in range(shards):
+        db.session.add(DispatchShard(period=billing_period(tick), send_day=tick.day, send_hour=tick.hour,
+                                     shard=index, shards=shards))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Already started, e.g. by a previous leader before it died
+            db.session.rollback()
+    return True
+
+
+def prune_shards(now=None):
+    """Delete shards that finished more than DONE_RETENTION ago. Returns the number deleted."""
+    cutoff = (now or datetime.utcnow()) - DONE_RETENTION
+    deleted = DispatchShard.query.filter(DispatchShard.status == 'done', DispatchShard.finished_at < cutoff) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def process_shard(shard, holder):
+    """
+    Queue the invoices of a shard whose lease `holder` holds. Returns False
+    if the lease was lost part way, leaving the rest to the new holder.
+    """
+    # Taking the lease committed, so these are re-read: another node may have
+    # finished the shard since we picked it
+    if shard.status == 'done':
+        release_lease(lease_name(shard), holder)
+        return False
+
+    tick = tick_of(shard)
+    last_seen = (shard.last_user_id, shard.last_client_id)
+    while True:
+        rows = due_page(tick, last_seen, shard.shard, shard.shards)
+        if not rows:
+            break
+        last_seen = (rows[-1][0].user_id, rows[-1][0].id)
+        queued = dispatch(rows, tick)
+        shard.last_user_id, shard.last_client_id = last_seen
+        shard.queued += queued
+        db.session.commit()
+        if not acquire_lease(lease_name(shard), holder):
+            logger.warning("⚠️ Lost dispatch shard %s/%s of tick %s", shard.shard, shard.shards, tick)
+            return False
+
+    shard.status = 'done'
+    shard.finished_at = datetime.utcnow()
+    db.session.commit()
+    release_lease(lease_name(shard), holder)
+    logger.info("✅ Dispatch shard %s/%s of tick %s queued %d invoices", shard.shard, shard.shards, tick, shard.queued)
+    return True
+
+
+def work_shards(holder):
+    """Claim and process pending shards until none is left unclaimed. Returns how many this holder finished."""
+    finished = 0
+    skipped = set()
+    while True:
+        shard = DispatchShard.query.filter(DispatchShard.status == 'pending',
+                                           DispatchShard.id.notin_(skipped)) \
+            .order_by(DispatchShard.id).first()
+        if shard is None:
+            return finished
+        if acquire_lease(lease_name(shard), holder) and process_shard(shard, holder):
+            finished += 1
+        else:
+            # Held by a live node; its lease expiring brings it back on a later poll
+            skipped.add(shard.id)
+
+
+class ShardWorker(threading.Thread):
+    """
+    Polls for pending dispatch shards on every node. With `drain_workers`,
+    it also sends what it queued; leave it 0 when sender processes do that.
+    """
+
+    def __init__(self, holder, drain_workers=0, poll_interval=POLL_INTERVAL):
+        super().__init__(name="dispatch-shards", daemon=True)
+        self.holder = holder
+        self.drain_workers = drain_workers
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        with app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    if work_shards(self.holder) and self.drain_workers:
+                        drain(workers=self.drain_workers)
+                except Exception:
+                    logger.exception("❌ Dispatch shard worker failed")
+                    db.session.rollback()
+                self._stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self._stopped.set()
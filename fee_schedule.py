@@ -0,0 +1,141 @@
+"""
+The one late-fee calculator.
+
+For a client's billing period we precompute the instants where the amount
+due steps up: the grace deadline (end of the last grace day), then every
+`duration` days after it until the next invoice. Each step adds one
+`late_fee`, and each step is also when a reminder is due. "Fee at time t" is
+then a binary search over that list, and "is a reminder due in this window"
+is two.
+
+Billing periods start on the client's send day. Months too short for the
+send day (e.g. day 31 in April) use their last day instead.
+"""
+import calendar
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+# Grace runs to the end of its last day
+GRACE_END_OF_DAY = timedelta(hours=23, minutes=59)
+
+
+def send_date(year, month, send_day):
+    return datetime(year, month, min(send_day, calendar.monthrange(year, month)[1]))
+
+
+def period_start(send_day, now=None):
+    """The latest send date on or before `now`"""
+    now = now or datetime.now()
+    start = send_date(now.year, now.month, send_day)
+    if start > now:
+        year, month = (now.year - 1, 12) if now.month == 1 else (now.year, now.month - 1)
+        start = send_date(year, month, send_day)
+    return start
+
+
+def next_period_start(start, send_day):
+    year, month = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+    return send_date(year, month, send_day)
+
+
+def next_send_at(send_day, send_hour, after):
+    """The first invoice time (send date at send_hour) strictly after `after`"""
+    year, month = after.year, after.month
+    while True:
+        at = send_date(year, month, send_day) + timedelta(hours=send_hour)
+        if at > after:
+            return at
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def boundary_epoch(now=None):
+    """
+    Which stretch between fee-schedule boundaries `now` falls in. Periods
+    start at midnight and every step is at GRACE_END_OF_DAY, so statuses and
+    fees computed at two instants with the same epoch are the same.
+    """
+    now = (now or datetime.now()).replace(microsecond=0)
+    return now.date().isoformat(), now - datetime(now.year, now.month, now.day) > GRACE_END_OF_DAY
+
+
+class FeeSchedule:
+    """Fee steps for one client in one billing period"""
+
+    __slots__ = ('cost', 'late_fee', 'grace_period', 'duration', 'invoice_sent_date',
+                 'grace_deadline', 'period_end', 'step_times')
+
+    def __init__(self, cost, grace_period, duration, late_fee, invoice_sent_date, period_end):
+        self.cost = float(cost)
+        self.late_fee = float(late_fee)
+        self.grace_period = grace_period
+        self.duration = max(int(duration), 1)
+        self.invoice_sent_date = invoice_sent_date
+        self.grace_deadline = invoice_sent_date + timedelta(days=grace_period) + GRACE_END_OF_DAY
+        self.period_end = period_end
+
+        # step_times[k] is when the k-th late fee is added (k=0 adds nothing:
+        # the invoice just became overdue)
+        step = timedelta(days=self.duration)
+        times = []
+        t = self.grace_deadline
+        while t < period_end or not times:
+            times.append(t)
+            t += step
+        self.step_times = times
+
+    def fee_count_at(self, t):
+        """How many late fees have been added by time t"""
+        index = bisect_right(self.step_times, t) - 1
+        if index < 0 or t <= self.grace_deadline:
+            return 0
+        return index
+
+    def amount_at(self, t):
+        return self.cost + self.late_fee * self.fee_count_at(t)
+
+    def is_overdue(self, t):
+        return t > self.grace_deadline
+
+    def reminders_between(self, start, end):
+        """Step times in (start, end]"""
+        return self.step_times[bisect_right(self.step_times, start):bisect_right(self.step_times, end)]
+
+    def reminder_due(self, now, window=timedelta(days=1)):
+        """Whether a step fell inside the last `window`, e.g. since the previous daily run"""
+        return bool(self.reminders_between(now - window, now))
+
+    def next_reminder_after(self, t):
+        index = bisect_left(self.step_times, t)
+        if index < len(self.step_times) and self.step_times[index] == t:
+            index += 1
+        return self.step_times[index] if index < len(self.step_times) else None
+
+    def late_fee_note(self, t):
+        count = self.fee_count_at(t)
+        if not count:
+            return ""
+        return (
+            f"\n⚠️ Late fees applied:\n"
+            f"- Grace period was {self.grace_period} days (until {self.grace_deadline.strftime('%Y-%m-%d %H:%M:%S')})\n"
+            f"- Late fees started on {self.grace_deadline.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"- Applied every {self.duration} day(s)\n"
+            f"- Total late fees: ${count * self.late_fee:.2f}\n"
+        )
+
+
+@lru_cache(maxsize=65536)
+def build_schedule(cost, grace_period, duration, late_fee, invoice_sent_date, period_end):
+    # Keyed on every input, so editing a client naturally gets a new schedule
+    return FeeSchedule(cost, grace_period, duration, late_fee, invoice_sent_date, period_end)
+
+
+def schedule_for(cost, grace_period, duration, late_fee, send_day, now=None):
+    """The (cached) schedule of the billing period containing `now`"""
+    start = period_start(send_day, now)
+    return build_schedule(cost, grace_period, duration, late_fee, start, next_period_start(start, send_day))
+
+
+def client_schedule(client, now=None):
+    return schedule_for(client.cost, client.grace_period, client.duration,
+                        client.late_fee, client.send_day, now)
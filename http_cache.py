@@ -0,0 +1,95 @@
+"""
+Conditional GET and response compression for the dashboards.
+
+A page's ETag is a hash of whatever it was rendered from: for the app that
+is the user's data_version (bumped in the same transaction as any change to
+their clients or revenue), the page options and fee_schedule.boundary_epoch(),
+since late fees and overdue flags move with the clock. A view calls
+
+    not_modified = http_cache.conditional(etag)
+    if not_modified:
+        return not_modified
+
+before doing any work, and the ETag is added to its 200 response. Only
+use it on pages that don't show flashed messages, which a 304 would replay.
+
+JSON and HTML responses of at least COMPRESS_MIN_SIZE bytes are compressed
+when the client accepts it: brotli if the optional `brotli` package is
+installed, gzip otherwise. Each encoding gets its own strong ETag.
+"""
+import gzip
+import hashlib
+import os
+
+from flask import current_app, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_MIMETYPES = ('text/html', 'application/json')
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def etag_for(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+
+
+def _variants(etag):
+    return [etag] + [f'{etag}-{encoding}' for encoding in ENCODINGS]
+
+
+def conditional(etag):
+    """A 304 response if the client already has this version, else None (and tag the coming 200)"""
+    g.etag = etag
+    for variant in _variants(etag):
+        if variant in request.if_none_match:
+            response = current_app.response_class(status=304)
+            _set_validators(response, variant)
+            return response
+    return None
+
+
+def _set_validators(response, etag):
+    response.set_etag(etag)
+    # Per user and short lived: browsers may keep it but must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(('Cookie', 'Accept-Encoding'))
+
+
+def _encoding():
+    for encoding in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _compress(response):
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return None
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return None
+    encoding = _encoding()
+    if encoding is None:
+        response.vary.add('Accept-Encoding')
+        return None
+    response.set_data(brotli.compress(body, quality=5) if encoding == 'br' else gzip.compress(body, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return encoding
+
+
+def finish_response(response):
+    encoding = _compress(response)
+    etag = g.pop('etag', None)
+    if etag and response.status_code == 200:
+        _set_validators(response, f'{etag}-{encoding}' if encoding else etag)
+    return response
+
+
+def init_app(app):
+    app.after_request(finish_response)
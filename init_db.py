@@ -1,10 +1,9 @@
-from app import app, db
+from migrations import upgrade
 
 def init_db():
-    with app.app_context():
-        # Create all tables
-        db.create_all()
-        print("Database initialized successfully!")
+    # Creates all tables, then applies any pending migrations
+    upgrade()
+    print("Database initialized successfully!")
 
 if __name__ == "__main__":
-    init_db() 
\ No newline at end of file
+    init_db()
@@ -0,0 +1,117 @@
+"""
+Vectorized invoice status and late-fee calculation.
+
+Takes columnar arrays for many clients and one reference timestamp, and works
+out every client's invoice date, grace deadline, overdue flag, late-fee
+multiplier and final cost in a handful of NumPy operations. This replaces
+per-row datetime.now() calls and Python loops in the dashboard, view_clients
+and the CSV dashboard.
+
+Results match fee_schedule row for row. They differ from the old per-client
+get_invoice_status_for_client, which is a deliberate behavior change:
+
+- The invoice date is the latest send date on or before now, not the next
+  one. The old code never showed a client overdue, because its invoice date
+  was always today or later.
+- final_cost includes the late fees added so far, where the old code always
+  showed the base cost.
+- Send days 29-31 fall on the last day of short months, instead of the 28th.
+
+On the send day itself (send days up to 28), both give the same result.
+benchmarks/bench_invoice_engine.py checks this.
+"""
+from datetime import datetime
+
+import numpy as np
+
+DAY = np.timedelta64(1, 'D')
+# Status deadlines run to the end of the last grace day
+END_OF_DAY = np.timedelta64(23 * 60 + 59, 'm')
+
+
+def _send_date(month, send_day):
+    month_start = month.astype('datetime64[D]')
+    days_in_month = ((month + 1).astype('datetime64[D]') - month_start).astype(np.int64)
+    return (month_start + (np.minimum(send_day, days_in_month) - 1) * DAY).astype('datetime64[s]')
+
+
+def compute_invoice_status(cost, grace_period, duration, late_fee, send_day, now=None):
+    """
+    Status for every client at once.
+
+    All inputs are equal-length array-likes; `now` is a single datetime shared
+    by every row. Returns a dict of arrays: invoice_sent_date, grace_deadline
+    (datetime64), is_overdue (bool), fee_multiplier (late fees added so far)
+    and final_cost.
+    """
+    now = np.datetime64(now or datetime.now(), 's')
+    cost = np.asarray(cost, dtype=float)
+    grace_period = np.asarray(grace_period, dtype=np.int64)
+    duration = np.maximum(np.asarray(duration, dtype=np.int64), 1)
+    late_fee = np.asarray(late_fee, dtype=float)
+    send_day = np.asarray(send_day, dtype=np.int64)
+
+    # Latest send date on or before now, clamping send days past month end
+    this_month = now.astype('datetime64[M]')
+    prev_month = this_month - 1
+    this_start = _send_date(this_month, send_day)
+    invoice_sent_date = np.where(this_start > now, _send_date(prev_month, send_day), this_start)
+
+    # Same formula as fee_schedule.FeeSchedule: one fee per full `duration`
+    # days past the end of the last grace day
+    grace_deadline = invoice_sent_date + grace_period * DAY + END_OF_DAY
+    is_overdue = now > grace_deadline
+    days_late = (now - grace_deadline) // DAY
+    fee_multiplier = np.where(is_overdue, days_late // duration, 0)
+    final_cost = cost + late_fee * fee_multiplier
+
+    return {
+        'invoice_sent_date': invoice_sent_date,
+        'grace_deadline': grace_deadline,
+        'is_overdue': is_overdue,
+        'fee_multiplier': fee_multiplier,
+        'final_cost': final_cost,
+    }
+
+
+def late_fee_note(fee_multiplier, late_fee):
+    if not fee_multiplier:
+        return "No late fee"
+    return f"{fee_multiplier}x late fee applied (${late_fee * fee_multiplier:.2f})"
+
+
+def invoice_statuses(clients, now=None):
+    """Status dicts, as used by the client templates, for a list of Client rows"""
+    if not clients:
+        return []
+
+    status = compute_invoice_status(
+        [c.cost for c in clients],
+        [c.grace_period for c in clients],
+        [c.duration for c in clients],
+        [c.late_fee for c in clients],
+        [c.send_day for c in clients],
+        now
+    )
+    sent_dates = status['invoice_sent_date'].astype(datetime).tolist()
+    deadlines = status['grace_deadline'].astype(datetime).tolist()
+    overdue = status['is_overdue'].tolist()
+    multipliers = status['fee_multiplier'].tolist()
+    final_costs = status['final_cost'].tolist()
+
+    return [{
+        'id': client.id,
+        'client_name': client.name,
+        'email': client.email,
+        'base_cost': client.cost,
+        'final_cost': final_costs[i],
+        'grace_period': client.grace_period,
+        'grace_deadline': deadlines[i],
+        'is_overdue': overdue[i],
+        'late_fee_note': late_fee_note(multipliers[i], client.late_fee),
+        'send_date': client.send_day,
+        'invoice_sent_date': sent_dates[i],
+        'is_paid': client.is_paid,
+        'payment_date': client.payment_date,
+        'is_late': client.is_late
+    } for i, client in enumerate(clients)]
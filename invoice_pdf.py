@@ -0,0 +1,263 @@
+"""
+PDF invoice attachments.
+
+Rendering a PDF is CPU-bound, so batches of invoices are rendered in a
+process pool before they reach the SMTP stage, instead of one at a time in
+the send loop. Rendered files are cached on disk, keyed by client, billing
+period and a digest of everything printed on the invoice (amount due, late
+fees, ...). Reminders re-sent at the same fee state reuse the cached bytes,
+and a change in the amount renders a new PDF. Files older than
+PDF_CACHE_MAX_AGE_DAYS are pruned, then the oldest ones until the cache
+fits in PDF_CACHE_MAX_MB.
+
+Attachments are off unless INVOICE_PDF=1.
+"""
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from fpdf import FPDF
+
+from log_config import redact
+from metrics import record_send
+
+ENABLED = os.getenv('INVOICE_PDF', '0').lower() not in ('0', 'false', 'no', '')
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', os.cpu_count() or 2))
+CACHE_DIR = os.getenv('PDF_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'invoice-pdfs')
+# Reminders within a billing period reuse a PDF, so keep a little over a month
+CACHE_MAX_AGE_DAYS = float(os.getenv('PDF_CACHE_MAX_AGE_DAYS', 40))
+CACHE_MAX_MB = float(os.getenv('PDF_CACHE_MAX_MB', 500))
+PRUNE_INTERVAL = 3600
+# Invoices rendered ahead of the sender when streaming
+LOOKAHEAD = int(os.getenv('PDF_LOOKAHEAD', 64))
+
+FIELDS = ('name', 'email', 'message', 'cost', 'grace_deadline', 'late_fee_amount',
+          'occupancy_days', 'late_fee_note', 'sender_email')
+
+_executor = None
+_executor_lock = threading.Lock()  # with_pdfs renders from a prefetch thread
+_last_prune = 0.0
+invoice_log = logging.getLogger('invoices')
+
+
+def _latin1(text):
+    # The core PDF fonts only cover Latin-1
+    return str(text or '').encode('latin-1', 'ignore').decode('latin-1').strip()
+
+
+def invoice_fields(invoice, period):
+    """What gets printed, from send_invoice kwargs; also the cache key's content"""
+    fields = {key: invoice.get(key) for key in FIELDS}
+    fields['period'] = period
+    fields['grace_deadline'] = fields['grace_deadline'].strftime('%Y-%m-%d %H:%M') if fields['grace_deadline'] else ''
+    return fields
+
+
+def render_pdf(fields):
+    """PDF bytes for one invoice. Runs in the worker processes."""
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    pdf.set_font('Helvetica', 'B', 20)
+    pdf.cell(0, 12, 'INVOICE', new_x='LMARGIN', new_y='NEXT')
+
+    pdf.set_font('Helvetica', '', 11)
+    pdf.cell(0, 6, _latin1(f"From: {fields['sender_email']}"), new_x='LMARGIN', new_y='NEXT')
+    pdf.cell(0, 6, _latin1(f"Billed to: {fields['name']} <{fields['email']}>"), new_x='LMARGIN', new_y='NEXT')
+    pdf.cell(0, 6, _latin1(f"Billing period: {fields['period']}"), new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(6)
+
+    pdf.set_fill_color(235, 237, 255)
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(120, 9, 'Total due', border=1, fill=True)
+    pdf.cell(0, 9, f"${fields['cost']:.2f}", border=1, fill=True, align='R', new_x='LMARGIN', new_y='NEXT')
+    pdf.set_font('Helvetica', '', 11)
+    pdf.cell(120, 8, 'Last day before late fees', border=1)
+    pdf.cell(0, 8, fields['grace_deadline'], border=1, align='R', new_x='LMARGIN', new_y='NEXT')
+    pdf.cell(120, 8, 'Late fee', border=1)
+    pdf.cell(0, 8, f"${fields['late_fee_amount']:.2f} every {fields['occupancy_days']} day(s)",
+             border=1, align='R', new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(6)
+
+    for text in (fields['late_fee_note'], fields['message']):
+        if _latin1(text):
+            pdf.multi_cell(0, 6, _latin1(text), new_x='LMARGIN', new_y='NEXT')
+            pdf.ln(3)
+    return bytes(pdf.output())
+
+
+def _cache_path(client_key, fields):
+    digest = hashlib.sha256(repr(sorted(fields.items())).encode('utf-8')).hexdigest()[:16]
+    safe_key = ''.join(c if c.isalnum() else '_' for c in str(client_key))
+    return os.path.join(CACHE_DIR, f"{safe_key}-{fields['period']}-{digest}.pdf")
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write(path, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write then rename, so readers never see a partial file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: the caller may be running scheduler or sender threads
+            _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def _attachment(fields, data):
+    return (f"invoice-{fields['period']}.pdf", 'application/pdf', data)
+
+
+def pdf_attachments(invoices, period=None):
+    """
+    One (filename, content type, bytes) attachment per send_invoice kwargs
+    dict, in order. Cache misses are rendered in parallel.
+    """
+    period = period or datetime.now().strftime('%Y-%m')
+    jobs = []
+    for invoice in invoices:
+        fields = invoice_fields(invoice, period)
+        path = _cache_path(invoice.get('client_id') or invoice['email'], fields)
+        jobs.append((fields, path, _read(path)))
+
+    missing = [(fields, path) for fields, path, data in jobs if data is None]
+    if len(missing) == 1:
+        rendered = [render_pdf(missing[0][0])]
+    elif missing:
+        rendered = list(_pool().map(render_pdf, [fields for fields, _ in missing]))
+    else:
+        rendered = []
+    for (fields, path), data in zip(missing, rendered):
+        _write(path, data)
+    if missing:
+        _prune_hourly()
+
+    rendered = iter(rendered)
+    return [_attachment(fields, data if data is not None else next(rendered))
+            for fields, path, data in jobs]
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _attach(batch, attachments):
+    try:
+        attachments = attachments.result()
+    except Exception:
+        # Find the invoices that fail one at a time, so the rest of the batch still goes out
+        yield from _attach_each(batch)
+        return
+    for invoice, attachment in zip(batch, attachments):
+        yield dict(invoice, attachments=[attachment])
+
+
+def _attach_each(batch):
+    for invoice in batch:
+        try:
+            attachments = pdf_attachments([invoice])
+        except Exception as e:
+            record_send(None, False)
+            invoice_log.error("❌ Failed to render the PDF invoice for %s: %s", redact(invoice['email']), e)
+            continue
+        yield dict(invoice, attachments=attachments)
+
+
+def with_pdfs(invoices, lookahead=LOOKAHEAD):
+    """
+    Stream send_invoice kwargs with their PDF added under "attachments".
+    The next `lookahead` invoices render while the current ones are sent.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            pending = None
+            for batch in _batches(invoices, lookahead):
+                future = prefetch.submit(pdf_attachments, batch)
+                if pending:
+                    yield from _attach(*pending)
+                pending = (batch, future)
+            if pending:
+                yield from _attach(*pending)
+    finally:
+        # Don't leave the pool to atexit, which multiprocessing children never run
+        shutdown()
+        prune_cache()
+
+
+def _prune_hourly():
+    # Every process that renders prunes its host's cache now and then, so
+    # long-running senders need no separate job
+    global _last_prune
+    if time.monotonic() - _last_prune >= PRUNE_INTERVAL:
+        _last_prune = time.monotonic()
+        prune_cache()
+
+
+def prune_cache(now=None):
+    """Delete cached PDFs past CACHE_MAX_AGE_DAYS, then the oldest beyond CACHE_MAX_MB. Returns the number deleted."""
+    now = now or time.time()
+    try:
+        entries = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue  # Pruned by another process
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for mtime, size, path in files:
+        if now - mtime <= CACHE_MAX_AGE_DAYS * 86400 and total <= CACHE_MAX_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return deleted
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+atexit.register(shutdown)
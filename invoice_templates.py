@@ -0,0 +1,210 @@
+"""
+Invoice emails rendered from compiled Jinja2 templates.
+
+Each user can set their own subject, plain-text and HTML invoice templates
+(User.invoice_subject, invoice_text and invoice_html); unset ones fall back
+to the defaults below. A template set is compiled once and cached by its
+source, together with its MIME skeleton: the multipart headers, boundaries
+and part headers that are identical for every invoice. Rendering an invoice
+then only fills in the recipient headers, renders the bodies and
+base64-encodes them into the skeleton, instead of building and serializing
+a new MIMEMultipart each time.
+
+Templates are user input, so they are compiled in Jinja2's immutable
+sandbox: they can read the variables below but not reach Python internals.
+
+Template variables: name, email, cc, message, cost, grace_deadline,
+late_fee_amount, occupancy_days, late_fee_note, period and sender_email.
+The `money` filter formats amounts with two decimals.
+"""
+import binascii
+import uuid
+from datetime import datetime
+from email.header import Header
+from email.utils import encode_rfc2231, formataddr, getaddresses
+from functools import lru_cache
+
+from jinja2 import TemplateError
+from jinja2.exceptions import SecurityError
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+DEFAULT_SUBJECT = "Monthly Invoice - {{ period }}"
+
+DEFAULT_TEXT = """\
+Hello {{ name }},
+
+{% if message %}{{ message }}
+
+{% endif %}Total due: ${{ cost|money }}
+Last day before Late fees: {{ grace_deadline.strftime('%Y-%m-%d %H:%M:%S') }}
+Late Fee of ${{ late_fee_amount|money }} will be applied every {{ occupancy_days }} day(s) from that date.
+{{ late_fee_note }}
+
+Thank you,
+GUK IL KIM
+"""
+
+CRLF = "\r\n"
+BASE64_LINE = 57  # Input bytes per 76-character base64 line
+
+
+def _money(value):
+    return f"{value:.2f}"
+
+
+def _environment(autoescape):
+    env = ImmutableSandboxedEnvironment(autoescape=autoescape, keep_trailing_newline=True)
+    env.filters['money'] = _money
+    return env
+
+
+TEXT_ENV = _environment(False)
+HTML_ENV = _environment(True)
+
+
+def _one_line(value):
+    # Folding whitespace collapsed, so a value can't inject headers
+    return ' '.join(str(value).split())
+
+
+def _header(value):
+    """An unstructured header value (the subject), RFC 2047 encoded if not ASCII"""
+    value = _one_line(value)
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode()
+
+
+def _addresses(value):
+    """
+    An address header value. Only display names are RFC 2047 encoded, since an
+    encoded address isn't a valid mailbox. Raises ValueError for a non-ASCII address.
+    """
+    return ', '.join(formataddr(pair, 'utf-8') for pair in getaddresses([_one_line(value)]))
+
+
+def _filename_param(filename):
+    filename = _one_line(filename).replace('"', '')
+    if filename.isascii():
+        return f'filename="{filename}"'
+    return f"filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+def _base64(data):
+    """Body bytes as base64 in 76-character CRLF lines"""
+    # Encode line-sized slices of a memoryview, so large attachments aren't
+    # copied before encoding
+    view = memoryview(data)
+    return ''.join(binascii.b2a_base64(view[i:i + BASE64_LINE], newline=False).decode('ascii') + CRLF
+                   for i in range(0, len(view), BASE64_LINE))
+
+
+def _part_headers(content_type):
+    return (f'Content-Type: {content_type}; charset="utf-8"{CRLF}'
+            f'MIME-Version: 1.0{CRLF}'
+            f'Content-Transfer-Encoding: base64{CRLF}{CRLF}')
+
+
+class InvoiceTemplate:
+    """Compiled subject and bodies plus the static parts of the MIME message"""
+
+    def __init__(self, subject, text, html=None):
+        self.subject = TEXT_ENV.from_string(subject)
+        self.text = TEXT_ENV.from_string(text)
+        self.html = HTML_ENV.from_string(html) if html else None
+
+        # Base64 never contains '-' or runs of '=', so fixed boundaries are safe
+        token = uuid.uuid4().hex
+        self.boundary = f"==============={token}=="
+        self.alternative_boundary = f"===============alt{token}=="
+
+        self.headers = (f'Content-Type: multipart/mixed; boundary="{self.boundary}"{CRLF}'
+                        f'MIME-Version: 1.0{CRLF}')
+        self.text_part = _part_headers('text/plain')
+        self.html_part = _part_headers('text/html')
+        self.body_open = f"{CRLF}--{self.boundary}{CRLF}"
+        if self.html:
+            # text and HTML alternatives nested inside the mixed message
+            self.body_open += (
+                f'Content-Type: multipart/alternative; boundary="{self.alternative_boundary}"{CRLF}'
+                f'MIME-Version: 1.0{CRLF}{CRLF}'
+                f"--{self.alternative_boundary}{CRLF}"
+            )
+        self.alternative_close = f"--{self.alternative_boundary}--{CRLF}"
+        self.close = f"--{self.boundary}--{CRLF}"
+
+    def render(self, context, sender_email, to, cc=None, attachments=()):
+        """
+        The serialized message for one invoice.
+
+        `attachments` is an iterable of (filename, content_type, bytes).
+        """
+        parts = [
+            self.headers,
+            f"From: {_addresses(sender_email)}{CRLF}",
+            f"To: {_addresses(to)}{CRLF}",
+            f"Subject: {_header(self.subject.render(context))}{CRLF}",
+        ]
+        if cc:
+            parts.append(f"Cc: {_addresses(cc)}{CRLF}")
+
+        parts += [self.body_open, self.text_part, _base64(self.text.render(context).encode('utf-8'))]
+        if self.html:
+            parts += [f"--{self.alternative_boundary}{CRLF}", self.html_part,
+                      _base64(self.html.render(context).encode('utf-8')), self.alternative_close]
+
+        for filename, content_type, data in attachments:
+            parts += [
+                f"--{self.boundary}{CRLF}",
+                f"Content-Type: {content_type}{CRLF}"
+                f"MIME-Version: 1.0{CRLF}"
+                f"Content-Transfer-Encoding: base64{CRLF}"
+                f'Content-Disposition: attachment; {_filename_param(filename)}{CRLF}{CRLF}',
+                _base64(data),
+            ]
+
+        parts.append(self.close)
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=256)
+def compile_template(subject=DEFAULT_SUBJECT, text=DEFAULT_TEXT, html=None):
+    # Keyed on the sources, so editing a template naturally compiles a new one
+    return InvoiceTemplate(subject, text, html)
+
+
+def template_for(user=None):
+    """The compiled invoice template of a User (defaults for None or unset fields)"""
+    return compile_template(
+        getattr(user, 'invoice_subject', None) or DEFAULT_SUBJECT,
+        getattr(user, 'invoice_text', None) or DEFAULT_TEXT,
+        getattr(user, 'invoice_html', None) or None
+    )
+
+
+def sample_context(sender_email="you@example.com"):
+    return {
+        'name': "Sample Client",
+        'email': "client@example.com",
+        'cc': "",
+        'message': "Thanks for your business.",
+        'cost': 100.0,
+        'grace_deadline': datetime.now(),
+        'late_fee_amount': 50.0,
+        'occupancy_days': 1,
+        'late_fee_note': "",
+        'period': datetime.now().strftime('%B %Y'),
+        'sender_email': sender_email,
+    }
+
+
+def validate_template(subject, text, html=None):
+    """None if the templates compile and render a sample invoice, otherwise the error"""
+    try:
+        template = InvoiceTemplate(subject or DEFAULT_SUBJECT, text or DEFAULT_TEXT, html or None)
+        template.render(sample_context(), "you@example.com", "client@example.com")
+    except SecurityError as e:
+        return f"Not allowed in invoice templates: {e}"
+    except (TemplateError, ValueError, TypeError, AttributeError) as e:
+        return str(e)
+    return None
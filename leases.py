@@ -0,0 +1,94 @@
+"""
+Time-limited leases stored in the database.
+
+A lease gives one process ownership of a named role (the scheduler, a
+dispatch shard, ...) until it expires. The holder renews it well before
+then, so if the process dies the lease lapses and another node takes over.
+Works the same on SQLite and Postgres because acquisition is a single
+conditional UPDATE, falling back to an INSERT guarded by the primary key.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, Lease
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = int(os.getenv('LEASE_TTL', 30))  # Seconds
+
+
+def acquire_lease(name, holder, ttl=LEASE_TTL):
+    """Take or renew `name` for `holder`. Returns True if we hold it now."""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    updated = Lease.query.filter(
+        Lease.name == name,
+        or_(Lease.holder == holder, Lease.expires_at < now)
+    ).update({'holder': holder, 'expires_at': expires_at}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+        return True
+
+    db.session.add(Lease(name=name, holder=holder, expires_at=expires_at))
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Someone else holds it and it hasn't expired
+        db.session.rollback()
+        return False
+
+
+def release_lease(name, holder):
+    Lease.query.filter_by(name=name, holder=holder).delete(synchronize_session=False)
+    db.session.commit()
+
+
+class LeaderElection(threading.Thread):
+    """
+    Keeps trying to hold lease `name` and calls on_elected/on_deposed as
+    leadership changes hands. Renews every third of the TTL.
+    """
+
+    def __init__(self, name, holder, on_elected, on_deposed, ttl=LEASE_TTL):
+        super().__init__(name=f"lease-{name}", daemon=True)
+        self.lease_name = name
+        self.holder = holder
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.ttl = ttl
+        self.is_leader = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        with app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    held = acquire_lease(self.lease_name, self.holder, self.ttl)
+                except Exception as e:
+                    # Can't reach the database: assume someone else may take over
+                    logger.error("❌ Lease '%s' renewal failed: %s", self.lease_name, e)
+                    db.session.rollback()
+                    held = False
+                if held and not self.is_leader:
+                    self.is_leader = True
+                    logger.info("👑 %s now holds '%s'", self.holder, self.lease_name)
+                    self.on_elected()
+                elif not held and self.is_leader:
+                    self.is_leader = False
+                    logger.warning("⚠️ %s lost '%s'", self.holder, self.lease_name)
+                    self.on_deposed()
+                self._stopped.wait(self.ttl / 3)
+
+            if self.is_leader:
+                self.is_leader = False
+                self.on_deposed()
+                release_lease(self.lease_name, self.holder)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,124 @@
+"""
+Logging setup shared by the web app, workers and scripts.
+
+    LOG_LEVEL   root level (default INFO)
+    LOG_FORMAT  "text" (default) or "json", one object per line
+    LOG_SAMPLE  fraction of records below WARNING to keep, per logger, e.g.
+                "invoices=0.01,app.requests=0.1"; warnings and errors are
+                always kept
+
+Handlers only put records on a queue. A QueueListener thread formats and
+writes them, so a slow terminal or log shipper never blocks a request or
+the send loop.
+
+Per-invoice outcomes go to the "invoices" logger and per-request details to
+"app.requests", so those are the ones worth sampling at volume. Use
+redact() for client email addresses.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# Attributes every LogRecord has; anything else came from `extra=`
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of a logger's (and its children's) records below WARNING"""
+
+    def __init__(self, rates):
+        super().__init__()
+        # Most specific logger name first
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        for name, rate in self.rates:
+            if record.name == name or record.name.startswith(name + '.'):
+                return random.random() < rate
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The stock handler merges the traceback into the message; keep it
+        # in exc_text instead, which both formatters know how to print
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(spec):
+    """Rates by logger name from a LOG_SAMPLE string; bad entries are ignored"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        try:
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+def setup_logging(level=None, fmt=None, sample=None, stream=None):
+    """Configure the root logger once per process; later calls do nothing"""
+    global _listener
+    if _listener is not None:
+        return
+    # Read here rather than at import, so values from .env apply
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.getenv('LOG_FORMAT', 'text')).lower()
+    sample = os.getenv('LOG_SAMPLE', '') if sample is None else sample
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.Queue(-1)
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(sample)))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    # Flush what's queued on exit
+    atexit.register(_listener.stop)
+
+
+def redact(email):
+    """alice@example.com -> a***@example.com, to tell clients apart without logging addresses"""
+    if not email:
+        return ''
+    local, _, domain = str(email).partition('@')
+    return f"{local[:1]}***@{domain}" if domain else f"{local[:1]}***"
@@ -1,15 +1,23 @@
 import csv
+import logging
+import os
+import zlib
 from datetime import datetime, timedelta
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email import policy
-import smtplib
 from datetime import datetime
 
-# Config (move to global or keep local)
-SMTP_SERVER = 'smtp.gmail.com'
-SMTP_PORT = 587
+from fee_schedule import build_schedule, next_period_start, period_start
+from invoice_templates import template_for
+from log_config import redact, setup_logging
+from metrics import RENDER_SECONDS, record_send
+from smtp_pool import pool
+
+# One line per invoice; sample with LOG_SAMPLE=invoices=0.01
+invoice_log = logging.getLogger('invoices')
+
+# Default server for senders that haven't set their own, e.g. a local sink for load tests
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
 
 def load_credentials(filename="data/user.csv"):
     with open(filename, newline='') as file:
@@ -17,29 +25,17 @@ def load_credentials(filename="data/user.csv"):
         credentials = next(reader)
         return credentials["email"], credentials["password"]
 
-def apply_late_fees(original_cost, grace_days, occupancy_days, late_fee_amount, invoice_sent_date):
-    now = datetime.now()
-    grace_deadline = invoice_sent_date + timedelta(days=grace_days, hours=23, minutes=59)
-    resend = False
-    late_fee_info = ""
-
-    if now > grace_deadline:
-        overdue_days = (now - grace_deadline).days
-        periods_overdue = overdue_days // occupancy_days
-        additional_fees = periods_overdue * late_fee_amount
-        resend = overdue_days % occupancy_days == 0
-
-        if periods_overdue > 0:
-            late_fee_info = (
-                f"\n⚠️ Late fees applied:\n"
-                f"- Grace period was {grace_days} days (until {grace_deadline.strftime('%Y-%m-%d %H:%M:%S')})\n"
-                f"- Late fees started on {grace_deadline.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"- Applied every {occupancy_days} day(s)\n"
-                f"- Total late fees: ${additional_fees:.2f}\n"
-            )
-        return float(original_cost), late_fee_info, resend, grace_deadline
-
-    return float(original_cost), "", False, grace_deadline
+def apply_late_fees(original_cost, grace_days, occupancy_days, late_fee_amount, invoice_sent_date, now=None,
+                    send_day=None):
+    # send_day: the invoice date is clamped in short months, the next one may not be
+    schedule = build_schedule(
+        original_cost, grace_days, occupancy_days, late_fee_amount,
+        invoice_sent_date, next_period_start(invoice_sent_date, send_day or invoice_sent_date.day)
+    )
+    now = now or datetime.now()
+    # Reminders go out on the run (daily cron) after each fee step
+    resend = schedule.reminder_due(now)
+    return schedule.amount_at(now), schedule.late_fee_note(now), resend, schedule.grace_deadline
 
 
 
@@ -49,96 +45,216 @@ def clean_hard(text):
     return text.replace('\xa0', ' ').encode("utf-8", "ignore").decode("utf-8").strip()
 
 
-def send_invoice(email, name, cc, cost, message, sender_email, sender_password, late_fee_note, grace_deadline, late_fee_amount, occupancy_days):
-    print("=== Starting email construction ===")
-
-    print(">> name:", repr(name))
-    print(">> email:", repr(email))
-    print(">> cc:", repr(cc))
-    print(">> message:", repr(message))
-    print(">> late_fee_note:", repr(late_fee_note))
-
-    name = clean_hard(name)
-    message = clean_hard(message)
-    late_fee_note = clean_hard(late_fee_note)
-    body_message = f"Hello {name},\n\n"
-
-    if message:
-        body_message += f"{message}\n\n"
-        
-    full_message = body_message + f"""\
-Total due: ${cost:.2f}
-Last day before Late fees: {grace_deadline.strftime('%Y-%m-%d %H:%M:%S')}
-Late Fee of ${late_fee_amount:.2f} will be applied every {occupancy_days} day(s) from that date.
-{late_fee_note}
+@RENDER_SECONDS.time()
+def build_invoice(email, name, cc, cost, message, sender_email, late_fee_note, grace_deadline, late_fee_amount, occupancy_days,
+                  template=None, attachments=(), period=None):
+    """Render the invoice email and return (recipients, serialized message)."""
+    template = template or template_for()
+    context = {
+        'name': clean_hard(name),
+        'email': email,
+        'cc': cc,
+        'message': clean_hard(message),
+        'cost': cost,
+        'grace_deadline': grace_deadline,
+        'late_fee_amount': late_fee_amount,
+        'occupancy_days': occupancy_days,
+        'late_fee_note': clean_hard(late_fee_note),
+        'period': period or datetime.now().strftime('%B %Y'),
+        'sender_email': sender_email,
+    }
 
-Thank you,
-GUK IL KIM
-"""
+    recipients = [email] + ([cc] if cc else [])
+    return recipients, template.render(context, sender_email, email, cc, attachments)
 
-    print("📩 Email body preview:\n", full_message[:300])
 
+def send_rendered(invoice):
+    """Send stage: deliver one rendered invoice (see render_invoices)"""
+    recipients, msg = invoice['rendered']
     try:
-        # Use policy.SMTPUTF8 to enforce UTF-8 support in headers/body
-        msg = MIMEMultipart(policy=policy.SMTPUTF8)
-        msg['From'] = sender_email
-        msg['To'] = email
-        msg['Subject'] = f"Monthly Invoice - {datetime.now().strftime('%B %Y')}"
-        if cc:
-            msg['Cc'] = cc
-
-        msg.attach(MIMEText(full_message, 'plain', 'utf-8'))
-
-        recipients = [email] + ([cc] if cc else [])
-
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            print("🔗 Connecting to SMTP...")
-            server.starttls()
-            print("🔐 TLS started.")
-            server.login(sender_email, sender_password)
-            print("✅ Logged in.")
-            # Send as string, with UTF-8 policy enforced
-            server.sendmail(sender_email, recipients, msg.as_string(policy=policy.SMTPUTF8))
-            print(f"✅ Invoice sent to {name} at {email}")
+        # Reuses an authenticated session for this sender when one is idle
+        pool.sendmail(
+            invoice.get('smtp_server', SMTP_SERVER), invoice.get('smtp_port', SMTP_PORT),
+            invoice['sender_email'], invoice['sender_password'],
+            invoice['sender_email'], recipients, msg
+        )
+        invoice_log.info("✅ Invoice sent to %s", redact(invoice['email']))
+        record_send(None, True)
 
     except Exception as e:
-        print(f"❌ Failed to send invoice to {email}: {e}")
+        record_send(None, False)
+        invoice_log.error("❌ Failed to send invoice to %s: %s", redact(invoice['email']), e)
+
+def send_invoice(email, name, cc, cost, message, sender_email, sender_password, late_fee_note, grace_deadline, late_fee_amount, occupancy_days,
+                 smtp_server=SMTP_SERVER, smtp_port=SMTP_PORT, attachments=()):
+    invoice = dict(
+        email=email, name=name, cc=cc, cost=cost, message=message,
+        sender_email=sender_email, sender_password=sender_password,
+        late_fee_note=late_fee_note, grace_deadline=grace_deadline,
+        late_fee_amount=late_fee_amount, occupancy_days=occupancy_days,
+        smtp_server=smtp_server, smtp_port=smtp_port, attachments=attachments
+    )
+    # Nothing comes out if rendering fails; render_invoices logs it
+    for rendered in render_invoices([invoice]):
+        send_rendered(rendered)
 
 def clean(text):
     if not text:
         return ""
     return text.replace('\xa0', ' ').encode('utf-8', 'ignore').decode('utf-8').strip()
 
-def process_clients(filename="data/clients.csv"):
-    invoice_sent_date = datetime(datetime.now().year, datetime.now().month, 1)
-    sender_email, sender_password = load_credentials("data/user.csv")
+# The CSV run is a chain of generators, one row in flight per stage, so
+# memory stays flat however large the file is:
+#   read_rows -> normalize -> in_shard -> due_invoices -> (PDFs) -> render_invoices -> send
+
+def default_source():
+    """The dashboard's store when there is one, since its edits never reach the CSV"""
+    import client_store
 
+    return client_store.DB_PATH if os.path.exists(client_store.DB_PATH) else "data/clients.csv"
+
+def read_rows(filename):
+    """Parse stage: (line number, raw row dict), read lazily; client ids for a dashboard store"""
+    import client_store
+
+    if filename == client_store.DB_PATH or filename.endswith(('.sqlite3', '.db')):
+        yield from client_store.rows(filename)
+        return
     with open(filename, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
-            name = clean(row["name"])
-            email = clean(row["email"])
-            cc = clean(row["cc"])
-            message = clean(row["message"])
-            base_cost = float(clean(row["cost"]))
-            grace_period = int(clean(row.get("grace_period", 3)))
-            occupancy = int(clean(row.get("duration", 1)))
-            late_fee_amount = float(clean(row.get("late_fee", 50))) # if late fees not set then $50 default
-            final_cost, late_fee_note, resend, grace_deadline = apply_late_fees(
-            base_cost, grace_period, occupancy, late_fee_amount, invoice_sent_date
+            yield reader.line_num, row
+
+def normalize(rows):
+    """Validate stage: cleaned, typed client fields; bad rows are logged and skipped"""
+    for line, row in rows:
+        try:
+            client = {
+                'name': clean(row["name"]),
+                'email': clean(row["email"]),
+                'cc': clean(row.get("cc")),
+                'message': clean(row.get("message")),
+                'cost': float(clean(row["cost"])),
+                'grace_period': int(clean(row.get("grace_period") or "3")),
+                'duration': int(clean(row.get("duration") or "1")),
+                'late_fee': float(clean(row.get("late_fee") or "50")),  # if late fees not set then $50 default
+                # Without the column everyone is invoiced on the 1st; the dashboard's export calls it send_date
+                'send_day': min(max(int(clean(row.get("send_day") or row.get("send_date") or "1")), 1), 31),
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            invoice_log.warning("⚠️ Skipping line %d of the clients CSV: %s", line, e)
+            continue
+        if not client['email']:
+            invoice_log.warning("⚠️ Skipping line %d of the clients CSV: no email", line)
+            continue
+        yield client
+
+def shard_of(email, shards):
+    # crc32 rather than hash(): it must agree across hosts and runs
+    return zlib.crc32(email.strip().lower().encode('utf-8')) % shards
+
+def in_shard(clients, shard, shards):
+    """Keep the clients whose email hashes to `shard` of `shards`"""
+    return (client for client in clients if shard_of(client['email'], shards) == shard)
+
+def due_invoices(clients, sender_email, sender_password, now=None):
+    """Due filter: send_invoice kwargs for every client with an invoice or reminder due today"""
+    now = now or datetime.now()
+
+    for client in clients:
+        # Same send dates as the app's send calendar: day 29-31 falls on the last day of short months
+        invoice_sent_date = period_start(client.get('send_day', 1), now)
+        is_initial_day = invoice_sent_date.date() == now.date()
+        final_cost, late_fee_note, resend, grace_deadline = apply_late_fees(
+            client['cost'], client['grace_period'], client['duration'], client['late_fee'],
+            invoice_sent_date, now, client.get('send_day')
         )
 
-        is_initial_day = datetime.now().day == invoice_sent_date.day
         if is_initial_day or resend:
-            send_invoice(
-                email, name, cc,
-                final_cost, message,
-                sender_email, sender_password,
-                late_fee_note,
-                grace_deadline,
-                late_fee_amount,
-                occupancy
+            yield dict(
+                email=client['email'], name=client['name'], cc=client['cc'],
+                cost=final_cost, message=client['message'],
+                sender_email=sender_email, sender_password=sender_password,
+                late_fee_note=late_fee_note,
+                grace_deadline=grace_deadline,
+                late_fee_amount=client['late_fee'],
+                occupancy_days=client['duration']
+            )
+
+def render_invoices(invoices, template=None, period=None):
+    """
+    Render stage: adds "rendered", the (recipients, message) to send.
+    An invoice that fails to render is logged and skipped, not the rest of the run.
+    """
+    template = template or template_for()
+    period = period or datetime.now().strftime('%B %Y')
+    for invoice in invoices:
+        try:
+            rendered = build_invoice(
+                invoice['email'], invoice['name'], invoice['cc'], invoice['cost'],
+                invoice['message'], invoice['sender_email'], invoice['late_fee_note'],
+                invoice['grace_deadline'], invoice['late_fee_amount'], invoice['occupancy_days'],
+                template=template, attachments=invoice.get('attachments', ()), period=period
             )
+        except Exception as e:
+            record_send(None, False)
+            invoice_log.error("❌ Failed to render invoice for %s: %s", redact(invoice['email']), e)
+            continue
+        yield dict(invoice, rendered=rendered)
+
+def parse_shard(value):
+    """"i/n" -> (i, n), counting shards from 0"""
+    shard, _, shards = value.partition('/')
+    shard, shards = int(shard), int(shards)
+    if not 0 <= shard < shards:
+        raise ValueError(f"shard must be 0..{shards - 1}/{shards}, not {value}")
+    return shard, shards
+
+def process_clients(filename=None, mode="sync", concurrency=None, rate_per_minute=None, shard=None):
+    """
+    Send every invoice due today from the clients CSV, or by default the
+    standalone dashboard's store when it exists.
+
+    mode="sync" sends one at a time over a pooled connection; mode="async"
+    runs the asyncio pipeline in async_sender with per-sender concurrency and
+    rate limits. `shard=(i, n)` only sends to clients whose email hashes to
+    shard i of n, so n hosts can split one file.
+    """
+    import invoice_pdf
+
+    sender_email, sender_password = load_credentials("data/user.csv")
+    clients = normalize(read_rows(filename or default_source()))
+    if shard:
+        clients = in_shard(clients, *shard)
+    invoices = due_invoices(clients, sender_email, sender_password)
+    if invoice_pdf.ENABLED:
+        # PDFs render in a process pool a batch ahead of the sender
+        invoices = invoice_pdf.with_pdfs(invoices)
+    invoices = render_invoices(invoices)
+
+    if mode == "async":
+        import asyncio
+        from async_sender import send_all
+
+        asyncio.run(send_all(invoices, concurrency=concurrency, rate_per_minute=rate_per_minute))
+        return
+
+    for invoice in invoices:
+        send_rendered(invoice)
 
 if __name__ == "__main__":
-    process_clients()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Send today's invoices from the clients CSV")
+    parser.add_argument("--file", help="clients CSV or dashboard store (default: data/clients.sqlite3 "
+                                        "if it exists, else data/clients.csv)")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--concurrency", type=int, help="parallel SMTP sessions per sender (async mode)")
+    parser.add_argument("--rate-per-minute", type=float, help="messages per minute per sender (async mode)")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="only clients whose email hashes to shard I of N (0-based)")
+    args = parser.parse_args()
+
+    setup_logging()
+    process_clients(args.file, mode=args.mode, concurrency=args.concurrency, rate_per_minute=args.rate_per_minute,
+                    shard=args.shard)
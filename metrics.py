@@ -0,0 +1,150 @@
+"""
+Prometheus metrics for the web app, scheduler and senders.
+
+The web app serves them at /metrics to scrapers that send
+`Authorization: Bearer $METRICS_TOKEN`, and not at all without a token.
+worker.py serves its own on METRICS_PORT when that is set. Under gunicorn or with worker.py sender
+processes, point PROMETHEUS_MULTIPROC_DIR at an empty directory shared by
+the processes of one host (cleared on deploy). Every process then writes its
+samples there, and either endpoint reports the sum.
+
+    smtp_phase_seconds{phase}             connect, starttls, login, send
+    invoice_render_seconds                template render + MIME serialization
+    invoices_sent_total{user, result}     sent / failed, per User id
+    http_request_seconds{endpoint}        whole request
+    db_query_seconds{endpoint}            time spent in SQL per request
+    outbox_queue_depth{status}            pending / sending / failed rows
+    scheduler_job_lag_seconds{job}        fire time to start of run
+    scheduler_jobs_missed_total{job}      runs skipped past misfire_grace_time
+    job_seconds{job}                      duration of instrumented jobs
+    client_cache_requests_total{cache, result}   hit / miss
+
+Time other code with the histograms' own .time(), e.g.
+
+    @JOB_SECONDS.labels('send_invoice_email').time()
+"""
+import hmac
+import os
+import re
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, generate_latest, multiprocess, start_http_server)
+
+# SMTP and SQL calls are mostly milliseconds; scheduler lag can be minutes
+FAST_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (.1, .5, 1, 5, 15, 30, 60, 300, 900, 3600)
+
+SMTP_PHASE_SECONDS = Histogram('smtp_phase_seconds', "Time per SMTP phase", ['phase'], buckets=FAST_BUCKETS)
+RENDER_SECONDS = Histogram('invoice_render_seconds', "Time to render and serialize one invoice email",
+                           buckets=FAST_BUCKETS)
+INVOICES_SENT = Counter('invoices_sent_total', "Invoices sent or failed, by sending User", ['user', 'result'])
+
+REQUEST_SECONDS = Histogram('http_request_seconds', "Request duration by route", ['endpoint'],
+                            buckets=FAST_BUCKETS)
+DB_SECONDS = Histogram('db_query_seconds', "SQL time per request by route", ['endpoint'], buckets=FAST_BUCKETS)
+
+QUEUE_DEPTH = Gauge('outbox_queue_depth', "Outbox rows waiting or in flight", ['status'],
+                    multiprocess_mode='livemax')
+
+JOB_LAG_SECONDS = Histogram('scheduler_job_lag_seconds', "Delay between a job's fire time and its start",
+                            ['job'], buckets=LAG_BUCKETS)
+JOBS_MISSED = Counter('scheduler_jobs_missed_total', "Job runs skipped for firing too late", ['job'])
+CACHE_REQUESTS = Counter('client_cache_requests_total', "Client snapshot cache lookups", ['cache', 'result'])
+JOB_SECONDS = Histogram('job_seconds', "Duration of scheduled and background jobs", ['job'], buckets=LAG_BUCKETS)
+
+
+def record_send(user_id, ok):
+    INVOICES_SENT.labels(str(user_id or ''), 'sent' if ok else 'failed').inc()
+
+
+def set_queue_depth(counts):
+    """Outbox row counts by status, refreshed when /metrics is scraped"""
+    for status in ('pending', 'sending', 'failed'):
+        QUEUE_DEPTH.labels(status).set(counts.get(status, 0))
+
+
+def job_name(job_id):
+    # dispatch_15_9 -> dispatch: one series per kind of job, not per bucket
+    return re.sub(r'(_\d+)+$', '', job_id)
+
+
+def _on_job_submitted(event):
+    now = time.time()
+    for run_time in event.scheduled_run_times:
+        JOB_LAG_SECONDS.labels(job_name(event.job_id)).observe(max(now - run_time.timestamp(), 0))
+
+
+def _on_job_missed(event):
+    JOBS_MISSED.labels(job_name(event.job_id)).inc()
+
+
+def instrument_scheduler(scheduler):
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+
+    scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(_on_job_missed, EVENT_JOB_MISSED)
+
+
+def instrument_app(app):
+    """Time every request and the SQL it runs, labelled by endpoint"""
+    from flask import g, has_request_context, request
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    # The start time lives on the statement's own context, so a statement
+    # that raises (and never reaches after_cursor_execute) can't skew the next
+    def add_db_time(context):
+        started = getattr(context, 'query_started', None)
+        if started is not None and has_request_context():
+            g.db_seconds = g.get('db_seconds', 0.0) + time.perf_counter() - started
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        add_db_time(context)
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_error(exception_context):
+        if exception_context.execution_context is not None:
+            add_db_time(exception_context.execution_context)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.teardown_request
+    def observe_request(exc=None):
+        started = g.get('request_started')
+        if started is None or request.endpoint == 'metrics_endpoint':
+            return
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+        DB_SECONDS.labels(endpoint).observe(g.get('db_seconds', 0.0))
+
+
+def authorized(header):
+    """Whether an Authorization header carries METRICS_TOKEN; always False when it isn't set"""
+    token = os.getenv('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest((header or '').encode(), f'Bearer {token}'.encode())
+
+
+def _registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def exposition():
+    """(body, content type) for a /metrics response"""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port):
+    """Serve /metrics from a background thread, for processes without Flask routes"""
+    start_http_server(port, registry=_registry())
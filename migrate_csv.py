@@ -1,18 +1,32 @@
+import csv
+import os
 import pandas as pd
-from datetime import datetime
-from app import app, db, User, Client
-from werkzeug.security import generate_password_hash
+from itertools import islice
+from app import app, db, User
+from client_import import import_clients, BATCH_SIZE
 
-def migrate_data():
+CLIENTS_CSV = 'data/clients.csv'
+# Rows of CLIENTS_CSV already committed, so a failed run can pick up where it stopped
+CHECKPOINT = CLIENTS_CSV + '.checkpoint'
+
+def read_checkpoint():
+    try:
+        with open(CHECKPOINT) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def write_checkpoint(rows_done):
+    # Write then rename, so a crash never leaves a half-written checkpoint
+    with open(CHECKPOINT + '.tmp', 'w') as f:
+        f.write(str(rows_done))
+    os.replace(CHECKPOINT + '.tmp', CHECKPOINT)
+
+def migrate_data(batch_size=BATCH_SIZE):
     with app.app_context():
-        # Create tables if they don't exist
-        db.create_all()
-        
         try:
-            # Read CSV files
-            clients_df = pd.read_csv('data/clients.csv')
             user_df = pd.read_csv('data/user.csv')
-            
+
             # Create default user if not exists
             user_email = user_df['email'].iloc[0]
             user = User.query.filter_by(email=user_email).first()
@@ -25,46 +39,39 @@ def migrate_data():
                 user.set_password('default_password')  # Set a default password
                 db.session.add(user)
                 db.session.commit()
-            
-            # Migrate each client
-            for _, row in clients_df.iterrows():
-                # Check if client already exists
-                existing_client = Client.query.filter_by(
-                    email=row['email'],
-                    name=row['name'],
-                    user_id=user.id
-                ).first()
-                
-                if not existing_client:
-                    # Convert date strings to datetime objects
-                    created_at = datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S.%f') if pd.notna(row['created_at']) else datetime.utcnow()
-                    payment_date = datetime.strptime(row['payment_date'], '%Y-%m-%d %H:%M:%S.%f') if pd.notna(row['payment_date']) else None
-                    
-                    client = Client(
-                        email=row['email'],
-                        name=row['name'],
-                        cc=row['cc'] if pd.notna(row['cc']) else None,
-                        cost=float(row['cost']),
-                        message=row['message'] if pd.notna(row['message']) else None,
-                        late_fee=float(row['late_fee']) if pd.notna(row['late_fee']) else 50.0,
-                        grace_period=int(row['grace_period']) if pd.notna(row['grace_period']) else 3,
-                        duration=int(row['duration']) if pd.notna(row['duration']) else 1,
-                        send_day=int(row['send_date']) if pd.notna(row['send_date']) else 1,
-                        send_hour=9,  # Default to 9 AM
-                        user_id=user.id,
-                        created_at=created_at,
-                        payment_status=row['payment_status'] if pd.notna(row['payment_status']) else 'Pending',
-                        payment_date=payment_date,
-                        is_late=bool(row['is_late']) if pd.notna(row['is_late']) else False
-                    )
-                    db.session.add(client)
-            
-            db.session.commit()
-            print("Migration completed successfully!")
-            
+
+            done = read_checkpoint()
+            if done:
+                print(f"Resuming after {done} rows already imported")
+
+            def progress(stats):
+                write_checkpoint(done + stats['read'])
+                print(f"  {done + stats['read']} rows, {stats['inserted']} inserted "
+                      f"({stats['rows_per_second']:.0f} rows/s)")
+
+            # Stream the file instead of loading it; rows are imported in batches
+            with open(CLIENTS_CSV, newline='') as f:
+                rows = islice(csv.DictReader(f), done, None)
+                stats = import_clients(rows, user.id, batch_size=batch_size, on_batch=progress)
+
+            if os.path.exists(CHECKPOINT):
+                os.remove(CHECKPOINT)
+            for error in stats['errors']:
+                print(f"Skipped row {done + error['row']}: {error['error']}")
+            print(f"Migration completed successfully! {stats['inserted']} clients added, "
+                  f"{stats['duplicates']} already present, {stats['invalid']} invalid "
+                  f"({stats['rows_per_second']:.0f} rows/s)")
+
         except Exception as e:
             print(f"Error during migration: {str(e)}")
+            print(f"Run again to resume from row {read_checkpoint()}")
             db.session.rollback()
 
 if __name__ == '__main__':
-    migrate_data() 
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import data/clients.csv into the database")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    migrate_data(args.batch_size)
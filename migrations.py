@@ -0,0 +1,181 @@
+"""
+Schema migrations.
+
+db.create_all() only creates missing tables, so indexes and columns added to
+an existing model never reach databases created before them. Migrations here
+are numbered steps, each applied once and recorded in `schema_migration`.
+app.py runs upgrade() at import; it is idempotent and safe to run from
+several processes at once. A step that raises MigrationError is skipped and
+retried on the next run. If a model's column is still missing afterwards,
+upgrade() raises instead of letting the app start.
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # list applied and pending migrations
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import func, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from app import app, db, ChangeLog, Client, DispatchShard, ImportJob, Revenue, SchemaMigration, SendCalendar, User
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationError(Exception):
+    """A migration that can't run until the data is fixed by hand"""
+
+
+def create_tables():
+    db.create_all()
+
+
+def create_table(model):
+    def migration():
+        model.__table__.create(db.engine, checkfirst=True)
+    return migration
+
+
+def add_columns(model, *names):
+    """ALTER TABLE ... ADD COLUMN for model columns the table doesn't have yet"""
+    def migration():
+        table = model.__table__
+        existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        for name in names:
+            if name in existing:
+                continue
+            column = table.columns[name]
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            if column.server_default is not None:
+                # Fills the column for existing rows
+                column_type += f" NOT NULL DEFAULT '{column.server_default.arg}'"
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {name} {column_type}')
+    return migration
+
+
+def create_indexes(*indexes):
+    def migration():
+        for index in indexes:
+            index.create(db.engine, checkfirst=True)
+    return migration
+
+
+def _index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def unique_client_email():
+    """One client per email per user, which add_client already checks for"""
+    duplicates = db.session.query(Client.user_id, Client.email) \
+        .group_by(Client.user_id, Client.email) \
+        .having(func.count(Client.id) > 1).limit(10).all()
+    if duplicates:
+        listed = ', '.join(f"{email} (user {user_id})" for user_id, email in duplicates)
+        raise MigrationError(f"Duplicate client emails must be merged or removed first: {listed}")
+    _index(Client, 'uq_client_user_email').create(db.engine, checkfirst=True)
+
+
+def create_send_calendar():
+    """The send calendar, with every existing client's next invoice"""
+    from send_calendar import fill
+
+    SendCalendar.__table__.create(db.engine, checkfirst=True)
+    fill()
+    db.session.commit()
+
+
+MIGRATIONS = [
+    (1, "Create tables", create_tables),
+    (2, "Indexes for dispatch, pagination and dashboard queries", create_indexes(
+        _index(Client, 'ix_client_send_day_hour_user'),
+        _index(Client, 'ix_client_user_name'),
+        _index(Client, 'ix_client_user_send_day'),
+        _index(Client, 'ix_client_user_is_paid'),
+        _index(Revenue, 'ix_revenue_user_payment_date'),
+        _index(Revenue, 'ix_revenue_client_id'),
+    )),
+    (3, "Unique client email per user", unique_client_email),
+    (4, "Bulk upload jobs", create_table(ImportJob)),
+    (5, "Per-user invoice templates", add_columns(User, 'invoice_subject', 'invoice_text', 'invoice_html')),
+    (6, "Sharded dispatch", create_table(DispatchShard)),
+    (7, "Per-user data versions for page ETags", add_columns(User, 'data_version')),
+    (8, "Invoice change feed", create_table(ChangeLog)),
+    (9, "Send calendar", create_send_calendar),
+    (10, "Bulk uploads imported by workers", add_columns(ImportJob, 'path', 'format', 'heartbeat_at')),
+]
+
+
+def applied_versions():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return {version for version, in db.session.query(SchemaMigration.version)}
+
+
+def upgrade():
+    """Apply pending migrations in order. Returns the versions applied."""
+    applied = []
+    with app.app_context():
+        done = applied_versions()
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                migrate()
+            except MigrationError as e:
+                # Not recorded, so it is retried on the next start; later
+                # migrations don't depend on it and still run
+                db.session.rollback()
+                logger.warning("⚠️ Migration %s (%s) not applied: %s", version, description, e)
+                continue
+            except (OperationalError, ProgrammingError):
+                # Usually another process creating the same index or table
+                # between our existence check and CREATE; the retry sees it
+                db.session.rollback()
+                migrate()
+
+            db.session.add(SchemaMigration(version=version, description=description,
+                                           applied_at=datetime.utcnow()))
+            try:
+                db.session.commit()
+                applied.append(version)
+                logger.info("🗄️ Applied migration %s: %s", version, description)
+            except IntegrityError:
+                db.session.rollback()
+        check_schema()
+    return applied
+
+
+def check_schema():
+    """Raise MigrationError if a model's table or column is missing, rather than failing on every query"""
+    inspector = inspect(db.engine)
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            missing.append(table.name)
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing += [f"{table.name}.{column.name}" for column in table.columns if column.name not in existing]
+    if missing:
+        raise MigrationError(f"The database is missing {', '.join(missing)}; run python migrations.py "
+                             f"and fix the errors it reports")
+
+
+def status():
+    with app.app_context():
+        done = applied_versions()
+    for version, description, _ in MIGRATIONS:
+        print(f"{'applied' if version in done else 'pending'}  {version:3d}  {description}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument("--status", action="store_true", help="List migrations instead of applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        status()
+    else:
+        upgrade()
@@ -0,0 +1,268 @@
+"""
+Durable invoice outbox.
+
+Every invoice is rendered and stored as an Outbox row before anything is sent.
+The row's idempotency key is (client_id, billing period), so a scheduler
+restart can't queue the same invoice twice, and a failed send is retried with
+exponential backoff and jitter instead of being lost.
+
+Any number of worker threads or processes can drain the table. Postgres rows
+are claimed with SELECT ... FOR UPDATE SKIP LOCKED. On SQLite a single UPDATE
+does the claim, which is atomic because SQLite serializes writers.
+
+Sent and failed rows are deleted after OUTBOX_RETENTION_DAYS (see prune).
+The keys are what stop a period's invoice being queued twice, so keep rows
+for longer than a billing month.
+
+Run a standalone worker with:
+
+    python outbox.py
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, Outbox, User, invoice_kwargs
+import invoice_pdf
+from invoice_templates import template_for
+from main import build_invoice, invoice_log, SMTP_SERVER, SMTP_PORT
+from metrics import record_send
+from smtp_pool import pool
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', 30))  # Seconds before the first retry
+BACKOFF_CAP = float(os.getenv('OUTBOX_BACKOFF_CAP', 3600))
+CLAIM_SIZE = int(os.getenv('OUTBOX_CLAIM_SIZE', 20))
+# A row still "sending" after this long belongs to a worker that died
+CLAIM_TIMEOUT = timedelta(seconds=int(os.getenv('OUTBOX_CLAIM_TIMEOUT', 300)))
+RETENTION_DAYS = max(int(os.getenv('OUTBOX_RETENTION_DAYS', 90)), 45)
+
+
+def billing_period(now=None):
+    return (now or datetime.now()).strftime('%Y-%m')
+
+
+def idempotency_key(client_id, period, reminder=None):
+    """One invoice per client per period, plus one per late-fee reminder step"""
+    if reminder is not None:
+        return f"{client_id}:{period}:r{reminder}"
+    return f"{client_id}:{period}"
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def render_invoice(client, user, period, kwargs=None, attachments=(), reminder=None):
+    """Column values for the Outbox row of one client's invoice"""
+    kwargs = kwargs or invoice_kwargs(client, user)
+    recipients, message = build_invoice(
+        kwargs['email'], kwargs['name'], kwargs['cc'], kwargs['cost'],
+        kwargs['message'], kwargs['sender_email'], kwargs['late_fee_note'],
+        kwargs['grace_deadline'], kwargs['late_fee_amount'], kwargs['occupancy_days'],
+        template=template_for(user), attachments=attachments
+    )
+    return dict(
+        idempotency_key=idempotency_key(client.id, period, reminder),
+        client_id=client.id,
+        user_id=user.id,
+        period=period,
+        recipients=','.join(recipients),
+        message=message
+    )
+
+
+def render_invoices(pairs, period, reminder=None):
+    """Outbox rows for (client, user) pairs, with PDFs rendered in parallel first"""
+    invoices = [dict(invoice_kwargs(client, user), client_id=client.id) for client, user in pairs]
+    if invoice_pdf.ENABLED:
+        attachments = [[pdf] for pdf in invoice_pdf.pdf_attachments(invoices, period)]
+    else:
+        attachments = [()] * len(invoices)
+    return [render_invoice(client, user, period, kwargs, files, reminder)
+            for (client, user), kwargs, files in zip(pairs, invoices, attachments)]
+
+
+def enqueue_invoices(pairs, period=None, reminder=None):
+    """
+    Queue invoices for (client, user) pairs, skipping ones already queued
+    for the period, or with `reminder` for that fee step's reminder. Returns
+    the number of new rows.
+    """
+    period = period or billing_period()
+    wanted = {idempotency_key(client.id, period, reminder): (client, user) for client, user in pairs}
+    if not wanted:
+        return 0
+
+    existing = {
+        key for key, in db.session.query(Outbox.idempotency_key)
+        .filter(Outbox.idempotency_key.in_(list(wanted)))
+    }
+    rows = render_invoices([pair for key, pair in wanted.items() if key not in existing], period, reminder)
+
+    db.session.add_all(Outbox(**row) for row in rows)
+    try:
+        db.session.commit()
+        return len(rows)
+    except IntegrityError:
+        # Another dispatcher queued some of these in the meantime
+        db.session.rollback()
+
+    added = 0
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Outbox(**row))
+            added += 1
+        except IntegrityError:
+            pass
+    db.session.commit()
+    return added
+
+
+def _due(now):
+    return or_(
+        and_(Outbox.status == 'pending', Outbox.next_attempt_at <= now),
+        and_(Outbox.status == 'sending', Outbox.claimed_at < now - CLAIM_TIMEOUT)
+    )
+
+
+def claim_batch(worker_id, limit=CLAIM_SIZE):
+    """Atomically mark up to `limit` due rows as ours and return them"""
+    now = datetime.utcnow()
+    token = f"{worker_id}:{uuid.uuid4().hex[:12]}"
+    candidates = select(Outbox.id).where(_due(now)).order_by(Outbox.next_attempt_at).limit(limit)
+
+    if db.engine.dialect.name == 'postgresql':
+        # Rows locked by other workers are skipped rather than waited on
+        candidates = [row_id for row_id, in db.session.execute(candidates.with_for_update(skip_locked=True))]
+        if not candidates:
+            db.session.commit()
+            return []
+
+    Outbox.query.filter(Outbox.id.in_(candidates), _due(now)).update(
+        {'status': 'sending', 'claimed_by': token, 'claimed_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return Outbox.query.filter_by(claimed_by=token, status='sending').all()
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, in seconds"""
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def deliver(row, user):
+    pool.sendmail(
+        user.smtp_server or SMTP_SERVER, user.smtp_port or SMTP_PORT,
+        user.smtp_username, user.smtp_password,
+        user.smtp_username, row.recipients.split(','), row.message
+    )
+
+
+def send_queued(key, worker_id=None):
+    """Send one queued row now if it is due, e.g. right after queueing it. Returns whether it was claimed."""
+    now = datetime.utcnow()
+    token = f"{worker_id or worker_name()}:{uuid.uuid4().hex[:12]}"
+    Outbox.query.filter(Outbox.idempotency_key == key, _due(now)).update(
+        {'status': 'sending', 'claimed_by': token, 'claimed_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return bool(_send_rows(Outbox.query.filter_by(claimed_by=token, status='sending').all()))
+
+
+def process_batch(worker_id):
+    """Claim and send one batch. Returns how many rows were claimed."""
+    return _send_rows(claim_batch(worker_id))
+
+
+def _send_rows(rows):
+    users = {}
+    for row in rows:
+        if row.user_id not in users:
+            users[row.user_id] = User.query.get(row.user_id)
+        try:
+            deliver(row, users[row.user_id])
+        except Exception as e:
+            row.attempts += 1
+            row.last_error = str(e)
+            if row.attempts >= MAX_ATTEMPTS:
+                row.status = 'failed'
+            else:
+                row.status = 'pending'
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(row.attempts))
+            record_send(row.user_id, False)
+            invoice_log.warning("❌ Failed to send invoice %s (attempt %d): %s", row.idempotency_key, row.attempts, e,
+                                extra={'client_id': row.client_id, 'user_id': row.user_id, 'attempts': row.attempts})
+        else:
+            row.status = 'sent'
+            row.sent_at = datetime.utcnow()
+            row.last_error = None
+            record_send(row.user_id, True)
+            invoice_log.info("✅ Invoice %s sent", row.idempotency_key,
+                             extra={'client_id': row.client_id, 'user_id': row.user_id})
+        # Commit per row so a crash mid-batch never resends delivered invoices
+        db.session.commit()
+    return len(rows)
+
+
+def prune(now=None):
+    """Delete sent and failed rows older than RETENTION_DAYS. Returns the number deleted."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=RETENTION_DAYS)
+    deleted = Outbox.query.filter(Outbox.status.in_(('sent', 'failed')), Outbox.created_at < cutoff) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def _drain_one(worker_id):
+    with app.app_context():
+        while process_batch(worker_id):
+            pass
+
+
+def drain(workers=1):
+    """Send everything currently due using `workers` threads, then return"""
+    if workers <= 1:
+        _drain_one(worker_name())
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(lambda: _drain_one(worker_name())) for _ in range(workers)]:
+            future.result()
+
+
+def run_worker(poll_interval=5.0):
+    """Send due invoices forever; run one per process to scale out"""
+    worker_id = worker_name()
+    logger.info("📬 Outbox worker %s started", worker_id)
+    with app.app_context():
+        try:
+            while True:
+                if not process_batch(worker_id):
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Send queued invoices from the outbox")
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    args = parser.parse_args()
+
+    run_worker(args.poll_interval)
@@ -1,4 +1,6 @@
-from app import app
+from app import app, start_embedded_scheduler
 
 if __name__ == "__main__":
+    # Dev convenience; in production run worker.py next to gunicorn instead
+    start_embedded_scheduler()
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""
+The send calendar: when each client's next invoice and reminder are due.
+
+Every client has an 'invoice' entry at its next send time, the send date at
+send_hour. Months too short for the send day use their last day, as in
+fee_schedule. With SEND_REMINDERS on, a client that was invoiced and hasn't
+paid also has a 'reminder' entry after its next fee step (the grace
+deadline, then every `duration` days). The entry is due at send_hour the
+morning after the step.
+
+Entries are updated in the same transaction as the client changes that move
+them: adding, editing, paying and deleting. The hourly tick (app.dispatch_due)
+then reads what is due from the due_at index in keyset pages, instead of
+scanning every client.
+
+When an invoice entry fires, its client starts a new billing period. A
+payment recorded before the period began is cleared, the invoice is queued,
+and the entry moves to the next send date. A tick that was missed is caught
+up by the next one, which takes everything due by then.
+"""
+import os
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_, or_, tuple_
+
+from app import db, Client, DISPATCH_BATCH_SIZE, Outbox, SendCalendar, User, log_changes
+from fee_schedule import client_schedule, next_send_at, period_start
+from outbox import billing_period, enqueue_invoices, idempotency_key
+
+SEND_REMINDERS = os.getenv('SEND_REMINDERS', '0').lower() not in ('0', 'false', 'no', '')
+FILL_BATCH_SIZE = 5000
+
+
+def reminder_time(step_time, send_hour):
+    # Steps fall at the end of a day; remind on the following morning
+    return datetime.combine(step_time.date() + timedelta(days=1), time(send_hour))
+
+
+def next_reminder(client, after):
+    """(due time, step) of the client's first reminder after `after` in the current period, or None"""
+    if not SEND_REMINDERS or client.is_paid:
+        return None
+    schedule = client_schedule(client, after)
+    for step, step_time in enumerate(schedule.step_times):
+        due_at = reminder_time(step_time, client.send_hour)
+        if due_at >= schedule.period_end:
+            break
+        if due_at > after:
+            return due_at, step
+    return None
+
+
+def _entry(client_id, kind):
+    return SendCalendar.query.filter_by(client_id=client_id, kind=kind).first()
+
+
+def _set_reminder(client, period, now):
+    """Point the client's reminder entry at its next reminder, or drop it if there is none"""
+    entry = _entry(client.id, 'reminder')
+    reminder = next_reminder(client, now)
+    if reminder is None:
+        if entry is not None:
+            db.session.delete(entry)
+        return
+    if entry is None:
+        entry = SendCalendar(client_id=client.id, user_id=client.user_id, kind='reminder')
+        db.session.add(entry)
+    entry.due_at, entry.step = reminder
+    entry.period = period
+
+
+def schedule_client(client, now=None):
+    """After adding or editing a client (flushed, so it has an id)"""
+    now = now or datetime.now()
+    entry = _entry(client.id, 'invoice')
+    due_at = next_send_at(client.send_day, client.send_hour, now)
+    if entry is None:
+        db.session.add(SendCalendar(client_id=client.id, user_id=client.user_id, kind='invoice',
+                                    due_at=due_at, period=billing_period(due_at)))
+    elif entry.due_at > now:
+        # Already due entries are left for the tick, or this period's invoice would be skipped
+        entry.due_at, entry.period = due_at, billing_period(due_at)
+
+    reminder = _entry(client.id, 'reminder')
+    if reminder is not None:
+        _set_reminder(client, reminder.period, now)
+
+
+def payment_changed(client, now=None):
+    """After toggling a payment: reminders stop when paid, and resume if it is undone"""
+    now = now or datetime.now()
+    if client.is_paid:
+        SendCalendar.query.filter_by(client_id=client.id, kind='reminder').delete(synchronize_session=False)
+        return
+    if not SEND_REMINDERS:
+        return
+    period = billing_period(period_start(client.send_day, now))
+    # No reminders for a period whose invoice never went out, e.g. for a new client
+    invoiced = db.session.query(Outbox.id).filter(
+        Outbox.idempotency_key == idempotency_key(client.id, period)).first()
+    if invoiced:
+        _set_reminder(client, period, now)
+
+
+def forget(client_id):
+    """Before deleting a client"""
+    SendCalendar.query.filter_by(client_id=client_id).delete(synchronize_session=False)
+
+
+def fill(*criteria, now=None):
+    """
+    Add invoice entries for clients matching `criteria` that have none, e.g.
+    after a bulk import or for existing clients. Returns the number added.
+    """
+    now = now or datetime.now()
+    has_entry = db.session.query(SendCalendar.id).filter(
+        SendCalendar.client_id == Client.id, SendCalendar.kind == 'invoice').exists()
+    added, last_id = 0, 0
+    while True:
+        clients = db.session.query(Client.id, Client.user_id, Client.send_day, Client.send_hour) \
+            .filter(Client.id > last_id, ~has_entry, *criteria) \
+            .order_by(Client.id).limit(FILL_BATCH_SIZE).all()
+        if not clients:
+            return added
+        entries = []
+        for client_id, user_id, send_day, send_hour in clients:
+            due_at = next_send_at(send_day, send_hour, now)
+            entries.append(dict(client_id=client_id, user_id=user_id, kind='invoice',
+                                due_at=due_at, period=billing_period(due_at)))
+        db.session.bulk_insert_mappings(SendCalendar, entries)
+        added += len(entries)
+        last_id = clients[-1][0]
+
+
+def due_page(until, last_seen=(0, 0), shard=0, shards=1):
+    """
+    The next DISPATCH_BATCH_SIZE (entry, client, user) triples due by
+    `until`, after `last_seen` (user_id, entry id)
+    """
+    query = (
+        db.session.query(SendCalendar, Client, User)
+        .join(Client, SendCalendar.client_id == Client.id)
+        .join(User, SendCalendar.user_id == User.id)
+        .filter(SendCalendar.due_at <= until)
+        .filter(tuple_(SendCalendar.user_id, SendCalendar.id) > last_seen)
+    )
+    if shards > 1:
+        query = query.filter(SendCalendar.client_id % shards == shard)
+    return query.order_by(SendCalendar.user_id, SendCalendar.id).limit(DISPATCH_BATCH_SIZE).all()
+
+
+def dispatch(rows, now=None):
+    """
+    Queue what a page of due entries calls for and move the entries on.
+    Returns the number of outbox rows queued.
+    """
+    now = now or datetime.now()
+    queue = {}  # (period, reminder step) -> (client, user) pairs
+    moves, dropped = [], []
+    new_periods = {}  # period start -> {client id: billing month}
+    for entry, client, user in rows:
+        if entry.kind == 'invoice':
+            queue.setdefault((entry.period, None), []).append((client, user))
+            # Months missed while no tick ran are not sent late
+            due_at = next_send_at(client.send_day, client.send_hour, max(entry.due_at, now))
+            moves.append(dict(id=entry.id, due_at=due_at, period=billing_period(due_at)))
+            new_periods.setdefault(period_start(client.send_day, entry.due_at), {})[client.id] = entry.period
+        elif (client.is_paid or not SEND_REMINDERS
+              or entry.period != billing_period(period_start(client.send_day, now))):
+            # Paid, or a period whose successor has begun (its invoice entry sets the new reminders)
+            dropped.append(entry.id)
+        else:
+            queue.setdefault((entry.period, entry.step), []).append((client, user))
+            reminder = next_reminder(client, max(entry.due_at, now))
+            if reminder is None:
+                dropped.append(entry.id)
+            else:
+                moves.append(dict(id=entry.id, due_at=reminder[0], step=reminder[1]))
+
+    queued = 0
+    for (period, step), pairs in queue.items():
+        queued += enqueue_invoices(pairs, period=period, reminder=step)
+
+    # Queued again harmlessly (idempotency keys) if this doesn't commit
+    db.session.bulk_update_mappings(SendCalendar, moves)
+    if dropped:
+        SendCalendar.query.filter(SendCalendar.id.in_(dropped)).delete(synchronize_session='fetch')
+    for started, periods in new_periods.items():
+        # Payments recorded since the period began belong to it; a toggle racing with this must not be undone
+        paid_before = and_(Client.id.in_(list(periods)), Client.is_paid.is_(True),
+                           or_(Client.payment_date.is_(None), Client.payment_date < started))
+        reset = [client_id for client_id, in db.session.query(Client.id).filter(paid_before)]
+        if reset:
+            log_changes(Client.id.in_(reset))
+            Client.query.filter(paid_before).update({'is_paid': False, 'payment_date': None},
+                                                    synchronize_session=False)
+        if SEND_REMINDERS:
+            for client in Client.query.filter(Client.id.in_(list(periods))):
+                _set_reminder(client, periods[client.id], now)
+    db.session.commit()
+    return queued
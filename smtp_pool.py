@@ -0,0 +1,148 @@
+import atexit
+import os
+import smtplib
+import threading
+import time
+
+from metrics import SMTP_PHASE_SECONDS
+
+# Reply codes that mean the server dropped or throttled the session. The
+# message itself is fine and can be retried on a fresh connection.
+RECONNECT_CODES = (421, 451)
+
+
+class PooledSession:
+    """An authenticated SMTP connection plus the bookkeeping the pool needs."""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP sessions alive between invoices.
+
+    Sessions are keyed by (server, port, username) so every sender account gets
+    its own connections. Idle sessions are checked with NOOP before reuse,
+    recycled after `max_messages_per_session` messages or `max_session_age`
+    seconds, and transparently replaced when the server answers 421/451.
+    """
+
+    def __init__(self, max_idle_per_key=4, max_messages_per_session=100,
+                 max_session_age=300, noop_after=30, timeout=30, retries=2,
+                 starttls=True, smtp_class=smtplib.SMTP):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_messages_per_session = max_messages_per_session
+        self.max_session_age = max_session_age
+        self.noop_after = noop_after
+        self.timeout = timeout
+        self.retries = retries
+        self.starttls = starttls
+        self.smtp_class = smtp_class
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, server, port, username, password):
+        with SMTP_PHASE_SECONDS.labels('connect').time():
+            smtp = self.smtp_class(server, port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                with SMTP_PHASE_SECONDS.labels('starttls').time():
+                    smtp.starttls()
+            if username:
+                with SMTP_PHASE_SECONDS.labels('login').time():
+                    smtp.login(username, password)
+        except Exception:
+            smtp.close()
+            raise
+        return PooledSession(smtp)
+
+    def _is_expired(self, session):
+        now = time.monotonic()
+        return (session.sent >= self.max_messages_per_session
+                or now - session.created_at >= self.max_session_age)
+
+    def _is_alive(self, session):
+        if time.monotonic() - session.last_used < self.noop_after:
+            return True
+        try:
+            code, _ = session.smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def _acquire(self, key, password):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+            if session is None:
+                return self._connect(*key, password)
+            if not self._is_expired(session) and self._is_alive(session):
+                return session
+            session.close()
+
+    def _release(self, key, session):
+        session.last_used = time.monotonic()
+        if not self._is_expired(session):
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_key:
+                    idle.append(session)
+                    return
+        session.close()
+
+    @staticmethod
+    def _should_reconnect(exc):
+        if isinstance(exc, smtplib.SMTPServerDisconnected):
+            return True
+        if isinstance(exc, smtplib.SMTPResponseException):
+            return exc.smtp_code in RECONNECT_CODES
+        if isinstance(exc, smtplib.SMTPRecipientsRefused):
+            codes = [code for code, _ in exc.recipients.values()]
+            return bool(codes) and all(code in RECONNECT_CODES for code in codes)
+        return False
+
+    def sendmail(self, server, port, username, password, from_addr, to_addrs, msg):
+        """Send one message over a pooled session, reconnecting on 421/451."""
+        key = (server, port, username)
+        for attempt in range(self.retries + 1):
+            session = self._acquire(key, password)
+            try:
+                with SMTP_PHASE_SECONDS.labels('send').time():
+                    refused = session.smtp.sendmail(from_addr, to_addrs, msg)
+            except Exception as exc:
+                session.close()
+                if attempt < self.retries and self._should_reconnect(exc):
+                    continue
+                raise
+            session.sent += 1
+            self._release(key, session)
+            return refused
+
+    def close_all(self):
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+# Only turn STARTTLS off for local test servers
+STARTTLS = os.getenv('SMTP_STARTTLS', '1') not in ('0', 'false', 'no')
+
+# Shared by main.send_invoice and app.send_invoice_email
+pool = SMTPConnectionPool(starttls=STARTTLS)
+atexit.register(pool.close_all)
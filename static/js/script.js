@@ -54,4 +54,150 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     });
-}); 
\ No newline at end of file
+}); 
+
+// Live invoice updates on the dashboard: apply deltas from the change feed
+// (change_feed.py) to the rows and totals instead of reloading the page
+function startInvoiceFeed() {
+    const body = document.body;
+    if (!body.dataset.changesUrl) {
+        return null;
+    }
+    let seq = Number(body.dataset.seq);
+    const epoch = JSON.stringify(JSON.parse(body.dataset.epoch));
+
+    function money(value) {
+        return '$' + Number(value).toFixed(2);
+    }
+
+    function setText(parent, selector, text) {
+        const element = parent.querySelector(selector);
+        if (element) {
+            element.textContent = text;
+        }
+    }
+
+    function applyClient(client) {
+        const row = document.querySelector(`tr[data-client-id="${client.id}"]`);
+        if (!row) {
+            return;  // Not on this page
+        }
+        setText(row, '.client-name', client.client_name);
+        setText(row, '.client-email', client.email);
+        setText(row, '.base-cost', money(client.base_cost));
+        setText(row, '.final-cost', money(client.final_cost));
+        setText(row, '.send-date', client.send_date);
+        setText(row, '.grace-period', client.grace_period + ' days');
+
+        const badge = row.querySelector('.payment-badge');
+        badge.textContent = client.is_paid ? 'Paid' : 'Pending';
+        badge.classList.toggle('bg-success', client.is_paid);
+        badge.classList.toggle('bg-warning', !client.is_paid);
+
+        const button = row.querySelector('.payment-toggle');
+        button.textContent = client.is_paid ? 'Mark as Pending' : 'Mark as Paid';
+        button.classList.toggle('btn-warning', client.is_paid);
+        button.classList.toggle('btn-success', !client.is_paid);
+    }
+
+    function applyTotals(totals) {
+        setText(document, '#total-revenue', money(totals.total_revenue));
+        setText(document, '#total-pending', money(totals.pending));
+        setText(document, '#total-late-fees', money(totals.late_fees));
+        setText(document, '#late-count',
+                totals.late_count + ' late invoice' + (totals.late_count === 1 ? '' : 's'));
+
+        const months = document.getElementById('revenue-by-month');
+        if (months) {
+            months.replaceChildren(...totals.revenue_by_month.map(function([month, amount]) {
+                const row = document.createElement('tr');
+                [month, money(amount)].forEach(function(text) {
+                    const cell = document.createElement('td');
+                    cell.textContent = text;
+                    row.appendChild(cell);
+                });
+                return row;
+            }));
+        }
+    }
+
+    function apply(delta) {
+        // Too much changed, the log was pruned, or late fees stepped up
+        if (delta.reset || JSON.stringify(delta.epoch) !== epoch) {
+            location.reload();
+            return;
+        }
+        if (delta.seq < seq) {
+            return;  // Older than what is shown
+        }
+        delta.changes.forEach(function(change) {
+            if (change.op === 'delete') {
+                const row = document.querySelector(`tr[data-client-id="${change.id}"]`);
+                if (row) {
+                    row.remove();
+                }
+            } else {
+                applyClient(change.client);
+            }
+        });
+        if (delta.totals) {
+            applyTotals(delta.totals);
+        }
+        seq = delta.seq;
+    }
+
+    function refresh() {
+        return fetch(`${body.dataset.changesUrl}?since=${seq}`)
+            .then(response => response.json())
+            .then(apply)
+            .catch(error => console.error('Change feed error:', error));
+    }
+
+    function poll() {
+        setInterval(function() {
+            if (!document.hidden) {
+                refresh();
+            }
+        }, Number(body.dataset.pollSeconds || 30) * 1000);
+    }
+
+    // Streams only when the server has them on (CHANGE_STREAM), otherwise polls
+    if (body.dataset.streamUrl && window.EventSource) {
+        const source = new EventSource(`${body.dataset.streamUrl}?since=${seq}`);
+        source.addEventListener('delta', event => apply(JSON.parse(event.data)));
+        source.addEventListener('error', function() {
+            // Closed for good, e.g. too many streams open: poll instead
+            if (source.readyState === EventSource.CLOSED) {
+                poll();
+            }
+        });
+    } else {
+        poll();
+    }
+
+    // Toggle payments in place; the change comes back through the feed
+    document.querySelectorAll('form[action*="toggle_payment_status"]').forEach(function(form) {
+        form.addEventListener('submit', function(event) {
+            event.preventDefault();
+            fetch(form.action, {method: 'POST', headers: {'X-Requested-With': 'XMLHttpRequest'}})
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        alert(data.message || 'Error toggling payment status');
+                        return;
+                    }
+                    return refresh();
+                })
+                .catch(function(error) {
+                    console.error('Error:', error);
+                    form.submit();
+                });
+        });
+    });
+
+    return {refresh: refresh};
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    window.invoiceFeed = startInvoiceFeed();
+});
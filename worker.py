@@ -0,0 +1,89 @@
+"""
+Background worker: owns invoice scheduling and sending, apart from the web app.
+
+    gunicorn -w 4 app:app          # HTTP only
+    python worker.py --senders 4   # scheduler + sender processes
+
+Any number of workers can run. They compete for the 'scheduler' lease and
+only the holder runs APScheduler jobs, so dispatch never happens twice. Every
+worker also keeps a pool of sender processes draining the outbox, which is how
+sending scales out. With DISPATCH_SHARDS set, every worker also helps queue
+each hourly tick's invoices (see dispatch_shards.py).
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+import app as web
+import metrics
+from dispatch_shards import ShardWorker
+from leases import LeaderElection
+from outbox import run_worker, worker_name
+
+logger = logging.getLogger(__name__)
+
+
+def start_sender(ctx, poll_interval):
+    process = ctx.Process(target=run_worker, args=(poll_interval,), daemon=True)
+    process.start()
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the invoice scheduler and outbox senders")
+    parser.add_argument("--senders", type=int, default=multiprocessing.cpu_count(),
+                        help="number of outbox sender processes")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+                        help="seconds a sender sleeps when the outbox is empty")
+    args = parser.parse_args()
+
+    if os.getenv('METRICS_PORT'):
+        # Set PROMETHEUS_MULTIPROC_DIR too, or the sender processes' metrics aren't included
+        metrics.serve(int(os.getenv('METRICS_PORT')))
+
+    # Dispatcher jobs only queue invoices; the sender processes deliver them
+    if args.senders:
+        web.DISPATCH_WORKERS = 0
+
+    # Fresh interpreters, so no SQLAlchemy connections are shared across forks
+    ctx = multiprocessing.get_context("spawn")
+    senders = [start_sender(ctx, args.poll_interval) for _ in range(args.senders)]
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    election = LeaderElection('scheduler', worker_name(), web.start_scheduler, web.stop_scheduler)
+    election.start()
+    shard_worker = None
+    if web.DISPATCH_SHARDS > 1:
+        # Every node queues dispatch shards, not just the scheduler leader
+        shard_worker = ShardWorker(worker_name(), drain_workers=web.DISPATCH_WORKERS)
+        shard_worker.start()
+    logger.info("🚀 Worker started with %d sender process(es)", args.senders)
+
+    while not stopping.wait(5):
+        # Replace senders that crashed
+        for i, process in enumerate(senders):
+            if not process.is_alive():
+                logger.warning("⚠️ Sender %s exited with %s, restarting", process.pid, process.exitcode)
+                senders[i] = start_sender(ctx, args.poll_interval)
+
+    election.stop()
+    election.join()
+    if shard_worker:
+        shard_worker.stop()
+        shard_worker.join()
+    if web.scheduler.running:
+        web.scheduler.shutdown()
+    for process in senders:
+        process.terminate()
+    for process in senders:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()